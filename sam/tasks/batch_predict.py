@@ -7,7 +7,7 @@ from flytekit import Resources, task
 from flytekit.extras.accelerators import T4
 from flytekit.types.directory import FlyteDirectory
 
-from .fine_tune import get_bounding_box, model_image
+from .fine_tune import BASE_MODEL, get_bounding_box, model_image
 
 if model_image.is_container():
     import matplotlib.pyplot as plt
@@ -15,6 +15,8 @@ if model_image.is_container():
     from datasets import load_dataset
     from transformers import SamProcessor
 
+    from .fine_tune import load_finetuned_sam
+
 
 def show_mask(mask, ax, random_color=False):
     if random_color:
@@ -28,15 +30,16 @@ def show_mask(mask, ax, random_color=False):
 
 @task(
     cache=True,
-    cache_version="2",
+    cache_version="3",
     container_image=model_image,
     requests=Resources(gpu="1", mem="20Gi"),
     accelerator=T4,
 )
-def batch_predict(model: torch.nn.Module) -> FlyteDirectory:
+def batch_predict(model: FlyteDirectory) -> FlyteDirectory:
     dataset = load_dataset("nielsr/breast-cancer", split="train")
-    processor = SamProcessor.from_pretrained("facebook/sam-vit-base")
+    processor = SamProcessor.from_pretrained(BASE_MODEL)
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = load_finetuned_sam(model.download()).to(device)
 
     # Set the number of images to process in a batch
     batch_size = 4
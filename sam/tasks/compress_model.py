@@ -1,17 +1,15 @@
 import tarfile
-from typing import Annotated
 
 from flytekit import task
-from flytekit.types.file import FileExt, FlyteFile
+from flytekit.types.directory import FlyteDirectory
+from flytekit.types.file import FlyteFile
 
 
 @task(
     cache=True,
-    cache_version="2",
+    cache_version="3",
 )
-def compress_model(
-    model: FlyteFile[Annotated[str, FileExt("PyTorchModule")]]
-) -> FlyteFile:
+def compress_model(model: FlyteDirectory) -> FlyteFile:
     file_name = "model.tar.gz"
     tf = tarfile.open(file_name, "w:gz")
     tf.add(model.download(), arcname="sam_finetuned")
@@ -7,6 +7,8 @@ from flytekitplugins.awssagemaker_inference import (
     create_sagemaker_deployment,
 )
 
+from .fine_tune import BASE_MODEL
+
 sam_deployment_image = ImageSpec(
     name="sam-deployment",
     registry=os.getenv("REGISTRY"),
@@ -19,7 +21,14 @@ sam_deployment_image = ImageSpec(
         "uvicorn==0.29.0",
     ],
     source_root="sam/tasks/fastapi",
-).with_commands(["chmod +x /root/serve"])
+).with_commands(
+    [
+        "chmod +x /root/serve",
+        # cache the base checkpoint fine-tuning records as base_model, app.py loads it
+        # with local_files_only and only downloads the fine-tuned decoder
+        f"python -c \"from transformers import SamModel, SamProcessor; SamModel.from_pretrained('{BASE_MODEL}'); SamProcessor.from_pretrained('{BASE_MODEL}')\"",
+    ]
+)
 
 
 sam_deployment = create_sagemaker_deployment(
@@ -1,5 +1,6 @@
 import base64
 import io
+import json
 import os
 from contextlib import asynccontextmanager
 from datetime import datetime
@@ -10,7 +11,8 @@ import torch
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import FileResponse
 from PIL import Image
-from transformers import SamProcessor
+from safetensors.torch import load_file
+from transformers import SamModel, SamProcessor
 
 
 def show_mask(mask, ax, random_color=False):
@@ -25,15 +27,28 @@ def show_mask(mask, ax, random_color=False):
 
 class Predictor:
     def __init__(self, path: str, name: str):
-        if torch.cuda.is_available():
-            map_location = "cuda:0"
-        else:
-            map_location = torch.device("cpu")
-        self._model = torch.load(os.path.join(path, name), map_location=map_location)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        # the model artifact only holds the fine-tuned mask decoder,
+        # the base checkpoint is baked into the image
+        model_dir = os.path.join(path, name)
+        with open(os.path.join(model_dir, "config.json"), "r") as file:
+            config = json.load(file)
+
+        self._processor = SamProcessor.from_pretrained(
+            config["base_model"], local_files_only=True
+        )
+        self._model = SamModel.from_pretrained(
+            config["base_model"], local_files_only=True
+        )
+        self._model.mask_decoder.load_state_dict(
+            load_file(os.path.join(model_dir, config["mask_decoder"]))
+        )
+        self._model.to(device)
 
     def predict(self, input: dict) -> np.ndarray:
         # prepare image + box prompt for the model
-        processor = SamProcessor.from_pretrained("facebook/sam-vit-base")
+        processor = self._processor
         device = "cuda" if torch.cuda.is_available() else "cpu"
 
         image = Image.open(
@@ -1,27 +1,76 @@
+import json
+import logging
 import os
+from dataclasses import dataclass
 
+import flytekit
 import numpy as np
 from flytekit import ImageSpec, Resources, task
 from flytekit.extras.accelerators import T4
+from flytekit.types.directory import FlyteDirectory
+from flytekitplugins.kfpytorch import Elastic
+from mashumaro.mixins.json import DataClassJSONMixin
 
 model_image = ImageSpec(
     name="sam-model",
     registry=os.getenv("REGISTRY"),
-    packages=["transformers", "torch", "monai", "flytekit", "datasets", "matplotlib"],
+    packages=[
+        "transformers",
+        "torch",
+        "monai",
+        "flytekit",
+        "flytekitplugins-kfpytorch",
+        "datasets",
+        "matplotlib",
+    ],
     cuda="12.1.0",
     cudnn="8",
     python_version="3.11",
 )
 
+# scale out fine-tuning with elastic DDP, e.g. SAM_NPROC_PER_NODE=4 for a 4xT4 node
+NNODES = int(os.getenv("SAM_NNODES", "1"))
+NPROC_PER_NODE = int(os.getenv("SAM_NPROC_PER_NODE", "1"))
+
+# only the mask decoder is fine-tuned, everything else is loaded from the base checkpoint
+BASE_MODEL = "facebook/sam-vit-base"
+MASK_DECODER_WEIGHTS = "mask_decoder.safetensors"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FineTuningArgs(DataClassJSONMixin):
+    num_epochs: int = 100
+    batch_size: int = 2
+    learning_rate: float = 1e-5
+    gradient_accumulation_steps: int = 1
+    # fp16 autocast with a GradScaler, a compiled mask decoder and fused Adam
+    performance_mode: bool = False
+    # checkpoint every n epochs so that retries can resume (0 disables)
+    checkpoint_every_epochs: int = 5
+    # fraction of the dataset held out to measure dice/iou after every epoch
+    validation_split: float = 0.1
+    # stop once validation dice hasn't improved by min_delta for this many epochs (0 disables)
+    early_stopping_patience: int = 10
+    early_stopping_min_delta: float = 1e-3
+    seed: int = 42
+
 
 if model_image.is_container():
-    from statistics import mean
+    import io
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from contextlib import nullcontext
 
     import monai
     import torch
+    import torch.distributed as dist
     from datasets import load_dataset
+    from safetensors.torch import load_file, save_file
+    from torch.nn.parallel import DistributedDataParallel
     from torch.optim import Adam
-    from torch.utils.data import DataLoader, Dataset
+    from torch.utils.data import DataLoader, Dataset, DistributedSampler
     from tqdm import tqdm
     from transformers import SamModel, SamProcessor
 
@@ -52,6 +101,90 @@ if model_image.is_container():
 
             return inputs
 
+    class AsyncCheckpointer:
+        """Writes training snapshots to the intra-task checkpoint in the background."""
+
+        def __init__(self, checkpoint):
+            self._checkpoint = checkpoint
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._pending = None
+
+        def restore(self):
+            data = self._checkpoint.read()
+            if data is None:
+                return None
+            return torch.load(io.BytesIO(data), map_location="cpu")
+
+        def save(self, state):
+            # copy to host memory on the training thread; the live tensors keep changing
+            snapshot = _to_cpu(state)
+            # keep at most one write in flight
+            self.wait()
+            self._pending = self._executor.submit(self._write, snapshot)
+
+        def wait(self):
+            if self._pending is not None:
+                # re-raises any error from the background write
+                self._pending.result()
+                self._pending = None
+
+        def _write(self, snapshot):
+            buffer = io.BytesIO()
+            torch.save(snapshot, buffer)
+            self._checkpoint.write(buffer.getvalue())
+
+    @torch.no_grad()
+    def evaluate(model, dataloader, device, use_amp, num_samples):
+        # sum dice and iou over the batch on the device, the caller syncs once per epoch
+        totals = torch.zeros(3, device=device)
+        seen = 0
+        for batch in dataloader:
+            with torch.autocast(
+                device_type=device, dtype=torch.float16, enabled=use_amp
+            ):
+                outputs = model(
+                    pixel_values=batch["pixel_values"].to(device),
+                    input_boxes=batch["input_boxes"].to(device),
+                    multimask_output=False,
+                )
+
+            # a positive logit is the same as a sigmoid probability above 0.5
+            predicted_masks = (outputs.pred_masks > 0).flatten(1)
+            ground_truth_masks = (batch["ground_truth_mask"].to(device) > 0).flatten(1)
+
+            intersection = (predicted_masks & ground_truth_masks).sum(1).float()
+            areas = predicted_masks.sum(1).float() + ground_truth_masks.sum(1).float()
+            dice = 2 * intersection / areas.clamp(min=1)
+            iou = intersection / (areas - intersection).clamp(min=1)
+
+            # only the first num_samples of the shard are real, the rest repeat
+            # samples to even out the shards
+            real = max(0, min(len(dice), num_samples - seen))
+            seen += len(dice)
+            dice, iou = dice[:real], iou[:real]
+
+            totals += torch.stack([dice.sum(), iou.sum(), dice.new_tensor(len(dice))])
+        return totals
+
+    def load_finetuned_sam(path):
+        with open(os.path.join(path, "config.json"), "r") as file:
+            config = json.load(file)
+
+        model = SamModel.from_pretrained(config["base_model"])
+        model.mask_decoder.load_state_dict(
+            load_file(os.path.join(path, config["mask_decoder"]))
+        )
+        return model
+
+    def _to_cpu(obj):
+        if isinstance(obj, torch.Tensor):
+            return obj.detach().to("cpu", copy=True)
+        if isinstance(obj, dict):
+            return {k: _to_cpu(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(_to_cpu(v) for v in obj)
+        return obj
+
 
 def get_bounding_box(ground_truth_map):
     # get bounding box from mask
@@ -72,61 +205,262 @@ def get_bounding_box(ground_truth_map):
 
 @task(
     cache=True,
-    cache_version="2",
+    cache_version="4",
     container_image=model_image,
-    requests=Resources(gpu="1", mem="20Gi"),
+    requests=Resources(gpu=str(NPROC_PER_NODE), mem="20Gi"),
     accelerator=T4,
+    retries=3,
+    task_config=Elastic(nnodes=NNODES, nproc_per_node=NPROC_PER_NODE),
 )
-def fine_tune_sam(dataset_name: str) -> torch.nn.Module:
+def fine_tune_sam(
+    dataset_name: str, args: FineTuningArgs = FineTuningArgs()
+) -> FlyteDirectory:
+    distributed = int(os.environ.get("WORLD_SIZE", "1")) > 1
+    local_rank = int(os.environ.get("LOCAL_RANK", "0"))
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if distributed:
+        dist.init_process_group(backend="nccl" if device == "cuda" else "gloo")
+    if device == "cuda":
+        torch.cuda.set_device(local_rank)
+    is_main_process = not distributed or dist.get_rank() == 0
+
+    logging.basicConfig(level=logging.INFO)
+
     dataset = load_dataset(dataset_name, split="train")
-    processor = SamProcessor.from_pretrained("facebook/sam-vit-base")
+    processor = SamProcessor.from_pretrained(BASE_MODEL)
+
+    val_dataloader = None
+    if args.validation_split > 0:
+        splits = dataset.train_test_split(
+            test_size=args.validation_split, seed=args.seed
+        )
+        dataset = splits["train"]
+        val_dataset = SAMDataset(dataset=splits["test"], processor=processor)
+        val_dataloader = DataLoader(
+            val_dataset,
+            batch_size=args.batch_size,
+            sampler=(
+                DistributedSampler(val_dataset, shuffle=False) if distributed else None
+            ),
+        )
+        # DistributedSampler pads the shards to the same length by repeating
+        # samples at the end of the last ones
+        val_samples = (
+            len(range(dist.get_rank(), len(val_dataset), dist.get_world_size()))
+            if distributed
+            else len(val_dataset)
+        )
+
     train_dataset = SAMDataset(dataset=dataset, processor=processor)
-    train_dataloader = DataLoader(train_dataset, batch_size=2, shuffle=True)
 
-    model = SamModel.from_pretrained("facebook/sam-vit-base")
+    # every rank works on its own shard of the dataset
+    sampler = DistributedSampler(train_dataset, shuffle=True) if distributed else None
+    train_dataloader = DataLoader(
+        train_dataset,
+        batch_size=args.batch_size,
+        shuffle=sampler is None,
+        sampler=sampler,
+    )
+
+    model = SamModel.from_pretrained(BASE_MODEL)
 
     # make sure we only compute gradients for mask decoder
     for name, param in model.named_parameters():
         if name.startswith("vision_encoder") or name.startswith("prompt_encoder"):
             param.requires_grad_(False)
 
+    model.to(device)
+
+    # mixed precision and fused kernels are only available on the GPU
+    use_amp = args.performance_mode and device == "cuda"
+
     # Note: Hyperparameter tuning could improve performance here
-    optimizer = Adam(model.mask_decoder.parameters(), lr=1e-5, weight_decay=0)
+    mask_decoder = model.mask_decoder
+    optimizer = Adam(
+        mask_decoder.parameters(),
+        lr=args.learning_rate,
+        weight_decay=0,
+        fused=use_amp,
+    )
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+
+    # resume from the latest checkpoint if this is a retry; every rank loads it,
+    # but only rank 0 writes new ones
+    start_epoch = 0
+    best_dice = -1.0
+    best_state = None
+    epochs_without_improvement = 0
+    checkpointer = None
+    if args.checkpoint_every_epochs > 0:
+        checkpointer = AsyncCheckpointer(flytekit.current_context().checkpoint)
+        state = checkpointer.restore()
+        if state is not None:
+            mask_decoder.load_state_dict(state["mask_decoder"])
+            optimizer.load_state_dict(state["optimizer"])
+            scaler.load_state_dict(state["scaler"])
+            best_dice = state["best_dice"]
+            best_state = state["best_state"]
+            epochs_without_improvement = state["epochs_without_improvement"]
+            start_epoch = state["epoch"] + 1
+            if is_main_process:
+                logger.info(json.dumps({"resumed_from_epoch": state["epoch"]}))
+        if not is_main_process:
+            checkpointer = None
+
+    if distributed:
+        # wrap only the mask decoder so the gradient all-reduce is limited to the
+        # parameters we actually train; the iou head doesn't contribute to the loss
+        model.mask_decoder = DistributedDataParallel(
+            mask_decoder,
+            device_ids=[local_rank] if device == "cuda" else None,
+            find_unused_parameters=True,
+        )
+
+    if args.performance_mode:
+        # only the mask decoder runs a backward pass, so that's where compilation pays off
+        model.mask_decoder = torch.compile(model.mask_decoder)
 
     seg_loss = monai.losses.DiceCELoss(
         sigmoid=True, squared_pred=True, reduction="mean"
     )
 
-    num_epochs = 100
+    model.train()
+    for epoch in range(start_epoch, args.num_epochs):
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+        if device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        epoch_start = time.perf_counter()
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model.to(device)
+        # accumulate on the device so that we don't sync with the host on every step
+        epoch_loss = torch.zeros((), device=device)
+        optimizer.zero_grad(set_to_none=True)
+        for step, batch in enumerate(
+            tqdm(train_dataloader, disable=not is_main_process)
+        ):
+            accumulating = (step + 1) % args.gradient_accumulation_steps != 0
+            sync_step = not accumulating or step + 1 == len(train_dataloader)
 
-    model.train()
-    for epoch in range(num_epochs):
-        epoch_losses = []
-        for batch in tqdm(train_dataloader):
-            # forward pass
-            outputs = model(
-                pixel_values=batch["pixel_values"].to(device),
-                input_boxes=batch["input_boxes"].to(device),
-                multimask_output=False,
+            # skip the gradient all-reduce until the last accumulated micro-batch
+            with (
+                model.mask_decoder.no_sync()
+                if distributed and not sync_step
+                else nullcontext()
+            ):
+                # forward pass
+                with torch.autocast(
+                    device_type=device, dtype=torch.float16, enabled=use_amp
+                ):
+                    outputs = model(
+                        pixel_values=batch["pixel_values"].to(device),
+                        input_boxes=batch["input_boxes"].to(device),
+                        multimask_output=False,
+                    )
+
+                # compute loss in full precision
+                predicted_masks = outputs.pred_masks.squeeze(1).float()
+                ground_truth_masks = batch["ground_truth_mask"].float().to(device)
+                loss = seg_loss(predicted_masks, ground_truth_masks.unsqueeze(1))
+                epoch_loss += loss.detach()
+
+                # backward pass (compute gradients of parameters w.r.t. loss)
+                scaler.scale(loss / args.gradient_accumulation_steps).backward()
+
+            # optimize once enough micro-batches have been accumulated
+            if sync_step:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+
+        epoch_loss /= len(train_dataloader)
+        if distributed:
+            dist.all_reduce(epoch_loss)
+            epoch_loss /= dist.get_world_size()
+
+        if device == "cuda":
+            torch.cuda.synchronize()
+        epoch_time = time.perf_counter() - epoch_start
+
+        metrics = {
+            "epoch": epoch,
+            "train_loss": epoch_loss.item(),
+            "epoch_time_s": round(epoch_time, 2),
+        }
+        if device == "cuda":
+            metrics["peak_memory_mib"] = round(
+                torch.cuda.max_memory_allocated() / 2**20
             )
 
-            # compute loss
-            predicted_masks = outputs.pred_masks.squeeze(1)
-            ground_truth_masks = batch["ground_truth_mask"].float().to(device)
-            loss = seg_loss(predicted_masks, ground_truth_masks.unsqueeze(1))
+        stop = False
+        if val_dataloader is not None:
+            model.eval()
+            totals = evaluate(model, val_dataloader, device, use_amp, val_samples)
+            model.train()
+            if distributed:
+                dist.all_reduce(totals)
+            val_dice, val_iou, count = totals.tolist()
+            metrics["val_dice"] = val_dice / count
+            metrics["val_iou"] = val_iou / count
 
-            # backward pass (compute gradients of parameters w.r.t. loss)
-            optimizer.zero_grad()
-            loss.backward()
+            # every rank sees the same reduced metrics, so they all stop together
+            if metrics["val_dice"] > best_dice + args.early_stopping_min_delta:
+                best_dice = metrics["val_dice"]
+                best_state = _to_cpu(mask_decoder.state_dict())
+                epochs_without_improvement = 0
+            else:
+                epochs_without_improvement += 1
+            stop = (
+                args.early_stopping_patience > 0
+                and epochs_without_improvement >= args.early_stopping_patience
+            )
+
+        if is_main_process:
+            logger.info(json.dumps(metrics))
 
-            # optimize
-            optimizer.step()
-            epoch_losses.append(loss.item())
+        if checkpointer is not None and (epoch + 1) % args.checkpoint_every_epochs == 0:
+            checkpointer.save(
+                {
+                    "epoch": epoch,
+                    "mask_decoder": mask_decoder.state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "scaler": scaler.state_dict(),
+                    "best_dice": best_dice,
+                    "best_state": best_state,
+                    "epochs_without_improvement": epochs_without_improvement,
+                }
+            )
+
+        if stop:
+            if is_main_process:
+                logger.info(
+                    json.dumps({"early_stopping_epoch": epoch, "best_dice": best_dice})
+                )
+            break
+
+    if checkpointer is not None:
+        checkpointer.wait()
+
+    # return the weights that scored best on the held-out split
+    if best_state is not None:
+        mask_decoder.load_state_dict(best_state)
+
+    # ship only the fine-tuned decoder along with a reference to the base checkpoint;
+    # with elastic training only rank 0's return value is kept
+    model_dir = os.path.join(
+        flytekit.current_context().working_directory, "sam_finetuned"
+    )
+    if is_main_process:
+        os.makedirs(model_dir, exist_ok=True)
+        save_file(
+            _to_cpu(mask_decoder.state_dict()),
+            os.path.join(model_dir, MASK_DECODER_WEIGHTS),
+        )
+        with open(os.path.join(model_dir, "config.json"), "w") as file:
+            json.dump(
+                {"base_model": BASE_MODEL, "mask_decoder": MASK_DECODER_WEIGHTS}, file
+            )
 
-        print(f"EPOCH: {epoch}")
-        print(f"Mean loss: {mean(epoch_losses)}")
+    if distributed:
+        dist.destroy_process_group()
 
-    return model
+    return FlyteDirectory(model_dir)
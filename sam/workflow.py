@@ -5,13 +5,14 @@ from flytekit import approve, workflow
 from .tasks.batch_predict import batch_predict
 from .tasks.compress_model import compress_model
 from .tasks.deploy import sam_deployment
-from .tasks.fine_tune import fine_tune_sam
+from .tasks.fine_tune import FineTuningArgs, fine_tune_sam
 
 
 @workflow
 def sam_sagemaker_deployment(
     execution_role_arn: str,
     dataset_name: str = "nielsr/breast-cancer",
+    finetuning_args: FineTuningArgs = FineTuningArgs(),
     model_name: str = "sam-model",
     endpoint_config_name: str = "sam-endpoint-config",
     endpoint_name: str = "sam-endpoint",
@@ -20,7 +21,7 @@ def sam_sagemaker_deployment(
     region: str = "us-east-2",
     output_path: str = "s3://sagemaker-sam/inference-output/output",
 ) -> str:
-    model = fine_tune_sam(dataset_name=dataset_name)
+    model = fine_tune_sam(dataset_name=dataset_name, args=finetuning_args)
     predictions = batch_predict(model=model)
 
     approve_filter = approve(
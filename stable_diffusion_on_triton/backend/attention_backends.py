@@ -0,0 +1,72 @@
+import logging
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+from diffusers.utils.import_utils import is_xformers_available
+
+logger = logging.getLogger(__name__)
+
+# "auto" resolves to one of the others depending on the device and what is installed
+ATTENTION_BACKENDS = ("auto", "sdpa", "xformers", "sliced", "vanilla")
+
+
+def resolve_attention_backend(
+    name: str, device: torch.device, xformers_available: Optional[bool] = None
+) -> str:
+    """Returns the backend `name` stands for on `device`.
+
+    "auto" picks PyTorch's scaled dot product attention, which has fused
+    kernels on CUDA and CPU, then xformers on CUDA, then vanilla attention.
+    """
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(
+            f"Unknown attention backend '{name}', "
+            f"expected one of {', '.join(ATTENTION_BACKENDS)}"
+        )
+    if xformers_available is None:
+        xformers_available = is_xformers_available()
+    has_sdpa = hasattr(F, "scaled_dot_product_attention")
+
+    if name == "auto":
+        if has_sdpa:
+            return "sdpa"
+        if xformers_available and device.type == "cuda":
+            return "xformers"
+        return "vanilla"
+    if name == "sdpa" and not has_sdpa:
+        raise ValueError("sdpa attention needs PyTorch 2.0 or later")
+    if name == "xformers":
+        if not xformers_available:
+            raise ValueError(
+                "xformers is not available. Make sure it is installed correctly"
+            )
+        if device.type != "cuda":
+            raise ValueError("xformers attention only runs on CUDA devices")
+    return name
+
+
+def set_attention_backend(model, backend: str, slice_size="auto"):
+    """Switches the attention layers of a diffusers `model` to a resolved `backend`.
+
+    Sliced attention computes `slice_size` heads at a time, "auto" being half
+    of them, trading speed for the memory of the attention scores.
+    """
+    if backend == "sdpa":
+        model.set_attn_processor(AttnProcessor2_0())
+    elif backend == "xformers":
+        import xformers
+        from packaging import version
+
+        if version.parse(xformers.__version__) == version.parse("0.0.16"):
+            logger.warning(
+                "xFormers 0.0.16 cannot be used for training in some GPUs. If you observe problems during training, please update xFormers to at least 0.0.17. See https://huggingface.co/docs/diffusers/main/en/optimization/xformers for more details."
+            )
+        model.enable_xformers_memory_efficient_attention()
+    elif backend == "sliced":
+        model.set_attention_slice(slice_size)
+    elif backend == "vanilla":
+        model.set_attn_processor(AttnProcessor())
+    else:
+        raise ValueError(f"Unresolved attention backend '{backend}'")
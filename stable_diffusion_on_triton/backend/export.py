@@ -24,74 +24,449 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
+import numpy as np
 import torch
 from diffusers import AutoencoderKL, DiffusionPipeline
-from transformers import CLIPTextModel, CLIPTokenizer
-
-if len(sys.argv) > 1:
-    model_name = sys.argv[1]
-    repo_id = sys.argv[2]
-    encoder_file_name = sys.argv[3]
-
-pipeline = DiffusionPipeline.from_pretrained(
-    model_name,
-    torch_dtype=torch.float16,
-).to("cuda")
-
-# load attention processors
-pipeline.load_lora_weights(repo_id)
-pipeline.save_pretrained("model_with_merged_weights")
-
-# VAE
-vae = AutoencoderKL.from_pretrained(
-    "model_with_merged_weights", subfolder="vae", cache_dir="hf_cache"
-)
-vae.forward = vae.decode
-torch.onnx.export(
-    vae,
-    (torch.randn(1, 4, 64, 64), False),
-    "vae.onnx",
-    input_names=["latent_sample", "return_dict"],
-    output_names=["sample"],
-    dynamic_axes={
-        "latent_sample": {0: "batch", 1: "channels", 2: "height", 3: "width"},
-    },
-    do_constant_folding=True,
-    opset_version=14,
-)
-
-# TEXT ENCODER
-tokenizer = CLIPTokenizer.from_pretrained(
-    "model_with_merged_weights", subfolder="tokenizer", cache_dir="hf_cache"
-)
-text_encoder = CLIPTextModel.from_pretrained(
-    "model_with_merged_weights", subfolder="text_encoder", cache_dir="hf_cache"
-)
-
-prompt = "Draw a dog"
-text_input = tokenizer(
-    prompt,
-    padding="max_length",
-    max_length=tokenizer.model_max_length,
-    truncation=True,
-    return_tensors="pt",
-)
-print(
-    "Here is the shape of the input -----------------------------------------------------"
-)
-print(text_input.input_ids.shape)
-
-torch.onnx.export(
-    text_encoder,
-    (text_input.input_ids.to(torch.int32)),
-    encoder_file_name,
-    input_names=["input_ids"],
-    output_names=["last_hidden_state", "pooler_output"],
-    dynamic_axes={
-        "input_ids": {0: "batch", 1: "sequence"},
-    },
-    opset_version=14,
-    do_constant_folding=True,
-)
+from onnxruntime.transformers import optimizer
+from quantize import CALIBRATION_PROMPTS, compare, quantize
+
+COMPONENTS = ("text_encoder", "vae", "unet")
+# int8 onnx copies of the text encoder and vae for the cpu endpoints
+QUANTIZED_COMPONENTS = ("text_encoder_int8", "vae_int8")
+PIPELINE_COMPONENTS = ("text_encoder", "unet", *QUANTIZED_COMPONENTS)
+QUANTIZATION_REPORT = "quantization_report.json"
+
+TRTEXEC = "/usr/src/tensorrt/bin/trtexec"
+MANIFEST_FILE = "export_manifest.json"
+
+
+def engine_target():
+    """Returns what the TensorRT engines built here only run on: the TensorRT
+    release and the GPU architecture."""
+    # set in the TensorRT images, otherwise read from trtexec's banner
+    version = os.environ.get("TRT_VERSION")
+    if version is None:
+        output = subprocess.run(
+            [TRTEXEC, "--help"], capture_output=True, text=True
+        ).stdout
+        match = re.search(r"TensorRT v(\d+)", output)
+        if match is None:
+            raise RuntimeError("Couldn't determine the TensorRT version of trtexec")
+        version = match.group(1)
+    major, minor = torch.cuda.get_device_capability()
+    return {
+        "tensorrt": version,
+        "compute_capability": f"{major}.{minor}",
+        "gpu": torch.cuda.get_device_name(),
+    }
+
+
+# optimization profiles of the engines, the unet batch holds a conditional and an
+# unconditional row per image
+VAE_SHAPES = {
+    "min": "latent_sample:1x4x64x64",
+    "opt": "latent_sample:4x4x64x64",
+    "max": "latent_sample:8x4x64x64",
+}
+VAE_FLAGS = ["--fp16", "--inputIOFormats=fp16:chw", "--outputIOFormats=fp16:chw"]
+UNET_SHAPES = {
+    "min": "sample:1x4x64x64,timestep:1,encoder_hidden_states:1x77x768",
+    "opt": "sample:8x4x64x64,timestep:8,encoder_hidden_states:8x77x768",
+    "max": "sample:16x4x64x64,timestep:16,encoder_hidden_states:16x77x768",
+}
+UNET_FLAGS = ["--fp16"]
+
+logger = logging.getLogger(__name__)
+
+
+class UNetWrapper(torch.nn.Module):
+    # returns the noise prediction as a plain tensor so it can be traced
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        return self.unet(sample, timestep, encoder_hidden_states, return_dict=False)[0]
+
+
+def export_unet(unet, onnx_path, batch_size=2, sequence_length=77, latent_size=64):
+    config = unet.config
+    sample = torch.randn(
+        batch_size,
+        config.in_channels,
+        latent_size,
+        latent_size,
+        dtype=unet.dtype,
+        device=unet.device,
+    )
+    # one timestep per row, so the batch dimension stays dynamic
+    timestep = torch.ones(batch_size, dtype=torch.float32, device=unet.device)
+    encoder_hidden_states = torch.randn(
+        batch_size,
+        sequence_length,
+        config.cross_attention_dim,
+        dtype=unet.dtype,
+        device=unet.device,
+    )
+
+    torch.onnx.export(
+        UNetWrapper(unet),
+        (sample, timestep, encoder_hidden_states),
+        onnx_path,
+        input_names=["sample", "timestep", "encoder_hidden_states"],
+        output_names=["out_sample"],
+        dynamic_axes={
+            "sample": {0: "batch", 2: "height", 3: "width"},
+            "timestep": {0: "batch"},
+            "encoder_hidden_states": {0: "batch"},
+            "out_sample": {0: "batch", 2: "height", 3: "width"},
+        },
+        do_constant_folding=True,
+        opset_version=14,
+    )
+
+
+def export_vae(vae, onnx_path, latent_size=64):
+    vae.forward = vae.decode
+    torch.onnx.export(
+        vae,
+        (torch.randn(1, vae.config.latent_channels, latent_size, latent_size), False),
+        onnx_path,
+        input_names=["latent_sample", "return_dict"],
+        output_names=["sample"],
+        dynamic_axes={
+            "latent_sample": {0: "batch", 1: "channels", 2: "height", 3: "width"},
+        },
+        do_constant_folding=True,
+        opset_version=14,
+    )
+
+
+def export_text_encoder(text_encoder, onnx_path, sequence_length=77, float16=True):
+    """Exports the text encoder for prompts padded to `sequence_length` tokens.
+
+    The export runs in fp32 on a copy of the encoder. ONNX Runtime then fuses
+    the attention and layer norm subgraphs, which the fixed sequence length
+    allows, and converts the weights and outputs to fp16 for the unet.
+    """
+    text_encoder = copy.deepcopy(text_encoder).float()
+    input_ids = torch.zeros(
+        (1, sequence_length), dtype=torch.int32, device=text_encoder.device
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_path = os.path.join(tmp_dir, "text_encoder.onnx")
+        torch.onnx.export(
+            text_encoder,
+            (input_ids,),
+            raw_path,
+            input_names=["input_ids"],
+            output_names=["last_hidden_state", "pooler_output"],
+            dynamic_axes={
+                "input_ids": {0: "batch"},
+                "last_hidden_state": {0: "batch"},
+                "pooler_output": {0: "batch"},
+            },
+            opset_version=14,
+            do_constant_folding=True,
+        )
+
+        config = text_encoder.config
+        model = optimizer.optimize_model(
+            raw_path,
+            model_type="clip",
+            num_heads=config.num_attention_heads,
+            hidden_size=config.hidden_size,
+        )
+    if float16:
+        model.convert_float_to_float16(keep_io_types=False)
+    model.save_model_to_file(onnx_path)
+
+
+def fused_pipeline(model_name, repo_id):
+    pipeline = DiffusionPipeline.from_pretrained(
+        model_name,
+        torch_dtype=torch.float16,
+    ).to("cuda")
+
+    # merge the LoRA into the base weights
+    pipeline.load_lora_weights(repo_id)
+    pipeline.fuse_lora()
+    pipeline.unload_lora_weights()
+    return pipeline
+
+
+class Exporter:
+    """Exports the selected components into a Triton model repository.
+
+    The vae is exported from the base weights while the LoRA is fused into the
+    pipeline, and each engine build overlaps with the exports that follow it.
+    The first failure cancels the remaining work and stops any running build.
+    The int8 components are quantized with `quantization`, either "dynamic" or
+    "static", and measured against their fp32 export on the CPU.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        repo_id,
+        model_repository,
+        work_dir=".",
+        quantization="dynamic",
+    ):
+        self.model_name = model_name
+        self.repo_id = repo_id
+        self.model_repository = model_repository
+        self.work_dir = work_dir
+        self.quantization = quantization
+        self.failed = threading.Event()
+        self.processes = []
+        self.lock = threading.Lock()
+        # torch.onnx.export keeps global state, so only one export runs at a time
+        self.onnx_lock = threading.Lock()
+
+    def run(self, components=COMPONENTS, max_workers=3):
+        """Returns a manifest of the written artifacts with their sizes, hashes
+        and the time each component took."""
+        started = time.perf_counter()
+        manifest = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            try:
+                if "vae" in components:
+                    futures["vae"] = executor.submit(
+                        self._timed, "vae", self.export_vae
+                    )
+
+                # the vae keeps exporting while the base pipeline loads
+                if any(component in components for component in PIPELINE_COMPONENTS):
+                    logger.info("pipeline: fusing the LoRA")
+                    pipeline_started = time.perf_counter()
+                    pipeline = fused_pipeline(self.model_name, self.repo_id)
+                    manifest["pipeline_seconds"] = round(
+                        time.perf_counter() - pipeline_started, 1
+                    )
+                    for component in PIPELINE_COMPONENTS:
+                        if component in components:
+                            export = getattr(self, f"export_{component}")
+                            futures[component] = executor.submit(
+                                self._timed, component, export, pipeline
+                            )
+            except BaseException:
+                # stop the running builds and drop the queued ones, rather than
+                # waiting for them when the executor shuts down
+                self._abort()
+                for future in futures.values():
+                    future.cancel()
+                raise
+
+            wait(futures.values(), return_when=FIRST_EXCEPTION)
+            for component, future in futures.items():
+                if future.done() and future.exception() is not None:
+                    self._abort()
+                    for pending in futures.values():
+                        pending.cancel()
+                    raise RuntimeError(
+                        f"exporting {component} failed"
+                    ) from future.exception()
+            for component, future in futures.items():
+                manifest[component] = future.result()
+
+        manifest["total_seconds"] = round(time.perf_counter() - started, 1)
+        return manifest
+
+    def export_vae(self):
+        onnx_path = os.path.join(self.work_dir, "vae.onnx")
+        plan_path = self._path("vae", "1", "model.plan")
+        with self.onnx_lock:
+            export_vae(self._base_vae(), onnx_path)
+        self._build_engine("vae", onnx_path, plan_path, VAE_SHAPES, VAE_FLAGS)
+        return [plan_path]
+
+    def export_text_encoder(self, pipeline):
+        onnx_path = self._path("text_encoder", "1", "model.onnx")
+        with self.onnx_lock:
+            export_text_encoder(
+                pipeline.text_encoder,
+                onnx_path,
+                sequence_length=pipeline.tokenizer.model_max_length,
+            )
+        return [onnx_path]
+
+    def export_unet(self, pipeline):
+        # loaded by the pipeline model from its version directory
+        weights_dir = self._path("pipeline", "1")
+        pipeline.unet.save_pretrained(
+            os.path.join(weights_dir, "unet"), safe_serialization=True
+        )
+        pipeline.tokenizer.save_pretrained(os.path.join(weights_dir, "tokenizer"))
+
+        onnx_path = os.path.join(self.work_dir, "unet.onnx")
+        plan_path = self._path("unet", "1", "model.plan")
+        with self.onnx_lock:
+            export_unet(
+                pipeline.unet,
+                onnx_path,
+                sequence_length=pipeline.tokenizer.model_max_length,
+            )
+        self._build_engine("unet", onnx_path, plan_path, UNET_SHAPES, UNET_FLAGS)
+        return [
+            os.path.join(weights_dir, "unet"),
+            os.path.join(weights_dir, "tokenizer"),
+            plan_path,
+        ]
+
+    def export_text_encoder_int8(self, pipeline):
+        fp32_path = os.path.join(self.work_dir, "text_encoder_fp32.onnx")
+        int8_path = self._path("text_encoder_int8", "1", "model.onnx")
+        sequence_length = pipeline.tokenizer.model_max_length
+        with self.onnx_lock:
+            export_text_encoder(
+                pipeline.text_encoder,
+                fp32_path,
+                sequence_length=sequence_length,
+                float16=False,
+            )
+
+        input_ids = pipeline.tokenizer(
+            CALIBRATION_PROMPTS,
+            padding="max_length",
+            max_length=sequence_length,
+            truncation=True,
+            return_tensors="np",
+        ).input_ids.astype(np.int32)
+        feeds = [{"input_ids": ids[None]} for ids in input_ids]
+        quantize(fp32_path, int8_path, self.quantization, feeds)
+        report = compare(fp32_path, int8_path, feeds, "last_hidden_state", "cosine")
+        return [int8_path, self._write_report("text_encoder_int8", report)]
+
+    def export_vae_int8(self, pipeline):
+        fp32_path = os.path.join(self.work_dir, "vae_fp32.onnx")
+        int8_path = self._path("vae_int8", "1", "model.onnx")
+
+        # calibrate on the latents the fused pipeline generates for the prompts,
+        # scaled the way the pipeline model hands them to the vae
+        with self.onnx_lock:
+            export_vae(self._base_vae(), fp32_path)
+            with torch.inference_mode():
+                latents = pipeline(
+                    CALIBRATION_PROMPTS, num_inference_steps=20, output_type="latent"
+                ).images
+        latents = (latents / 0.18215).float().cpu().numpy()
+        feeds = [{"latent_sample": latent[None]} for latent in latents]
+        quantize(fp32_path, int8_path, self.quantization, feeds)
+        report = compare(fp32_path, int8_path, feeds, "sample", "psnr")
+        return [int8_path, self._write_report("vae_int8", report)]
+
+    def _base_vae(self):
+        # the LoRA doesn't touch the vae, so it comes straight from the base model
+        return AutoencoderKL.from_pretrained(self.model_name, subfolder="vae")
+
+    def _write_report(self, name, report):
+        # kept next to the model so that cached copies carry their report along
+        logger.info(f"{name}: {self.quantization} quantization {report}")
+        path = self._path(name, QUANTIZATION_REPORT)
+        with open(path, "w") as f:
+            json.dump(dict(report, quantization=self.quantization), f, indent=2)
+        return path
+
+    def _path(self, *parts):
+        path = os.path.join(self.model_repository, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _timed(self, name, export, *args):
+        if self.failed.is_set():
+            raise RuntimeError("cancelled after an earlier failure")
+        logger.info(f"{name}: started")
+        started = time.perf_counter()
+        try:
+            paths = export(*args)
+        except Exception:
+            self._abort()
+            raise
+        seconds = round(time.perf_counter() - started, 1)
+        logger.info(f"{name}: finished in {seconds}s")
+        return {"seconds": seconds, "artifacts": self._describe(paths)}
+
+    def _describe(self, paths):
+        artifacts = []
+        for path in paths:
+            files = [path]
+            if os.path.isdir(path):
+                files = sorted(
+                    os.path.join(root, name)
+                    for root, _, names in os.walk(path)
+                    for name in names
+                )
+            for file in files:
+                artifacts.append(
+                    {
+                        "path": os.path.relpath(file, self.model_repository),
+                        "bytes": os.path.getsize(file),
+                        "sha256": _sha256(file),
+                    }
+                )
+        return artifacts
+
+    def _build_engine(self, name, onnx_path, plan_path, shapes, flags):
+        command = [
+            TRTEXEC,
+            f"--onnx={onnx_path}",
+            f"--saveEngine={plan_path}",
+            f"--minShapes={shapes['min']}",
+            f"--optShapes={shapes['opt']}",
+            f"--maxShapes={shapes['max']}",
+            *flags,
+        ]
+        # checked under the lock, so an abort can't miss a build starting
+        with self.lock:
+            if self.failed.is_set():
+                raise RuntimeError("cancelled after an earlier failure")
+            process = subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+            )
+            self.processes.append(process)
+        for line in process.stdout:
+            logger.info(f"{name}: {line.rstrip()}")
+        if process.wait() != 0:
+            raise RuntimeError(f"trtexec exited with code {process.returncode}")
+
+    def _abort(self):
+        self.failed.set()
+        with self.lock:
+            for process in self.processes:
+                if process.poll() is None:
+                    process.terminate()
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+if __name__ == "__main__":
+    # writes the selected components into a triton model repository
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    model_name, repo_id, model_repository = sys.argv[1:4]
+    components = sys.argv[4:] or COMPONENTS
+
+    manifest = Exporter(model_name, repo_id, model_repository).run(components)
+    with open(os.path.join(model_repository, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
@@ -0,0 +1,137 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+import onnxruntime as ort
+from onnx import TensorProto
+from onnxruntime.quantization import (
+    CalibrationDataReader,
+    QuantFormat,
+    QuantType,
+    quant_pre_process,
+    quantize_dynamic,
+    quantize_static,
+)
+
+QUANTIZATION_MODES = ("none", "dynamic", "static")
+
+# shape inference can't type the outputs of the fused contrib ops
+EXTRA_OPTIONS = {"DefaultTensorType": TensorProto.FLOAT}
+# static quantization leaves the norms, softmax and the attention masks in fp32,
+# their activation ranges don't survive int8
+STATIC_OP_TYPES = ["Conv", "MatMul", "Gemm"]
+
+# calibration inputs for the static quantization and the inputs the reports are
+# measured on, so keep them close to what the endpoint is asked for
+CALIBRATION_PROMPTS = [
+    "cute dragon creature",
+    "a photograph of an astronaut riding a horse",
+    "a watercolor painting of a lighthouse at dawn",
+    "portrait of an old fisherman, dramatic lighting",
+    "a bowl of ramen, studio photo",
+    "pixel art of a castle on a hill",
+    "a red sports car in the rain at night",
+    "low poly fox in a snowy forest",
+]
+
+
+class FeedReader(CalibrationDataReader):
+    def __init__(self, feeds):
+        self.feeds = iter(feeds)
+
+    def get_next(self):
+        return next(self.feeds, None)
+
+
+def quantize(fp32_path, int8_path, mode, calibration_feeds=None):
+    """Writes an int8 copy of an fp32 ONNX model.
+
+    Dynamic quantization only needs the weights, static quantization also
+    calibrates the activation ranges on `calibration_feeds`.
+    """
+    if mode == "dynamic":
+        quantize_dynamic(
+            fp32_path,
+            int8_path,
+            weight_type=QuantType.QInt8,
+            extra_options=EXTRA_OPTIONS,
+        )
+    elif mode == "static":
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            preprocessed_path = os.path.join(tmp_dir, "preprocessed.onnx")
+            quant_pre_process(fp32_path, preprocessed_path)
+            quantize_static(
+                preprocessed_path,
+                int8_path,
+                FeedReader(calibration_feeds),
+                quant_format=QuantFormat.QDQ,
+                weight_type=QuantType.QInt8,
+                op_types_to_quantize=STATIC_OP_TYPES,
+                per_channel=True,
+                extra_options=EXTRA_OPTIONS,
+            )
+    else:
+        raise ValueError(
+            f"Unknown quantization mode '{mode}', "
+            f"expected one of {', '.join(QUANTIZATION_MODES[1:])}"
+        )
+
+
+def _cpu_session(path):
+    return ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+
+def _run(session, feeds, output_name):
+    # the first pass warms the session up, the second one is timed
+    outputs = [session.run([output_name], feed)[0] for feed in feeds]
+    start = time.perf_counter()
+    for feed in feeds:
+        session.run([output_name], feed)
+    return outputs, (time.perf_counter() - start) / len(feeds)
+
+
+def _cosine_similarity(reference, quantized):
+    reference = reference.reshape(len(reference), -1).astype(np.float64)
+    quantized = quantized.reshape(len(quantized), -1).astype(np.float64)
+    return np.sum(reference * quantized, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(quantized, axis=1)
+    )
+
+
+def _psnr(reference, quantized):
+    # decoded images are in [-1, 1], compare them as the [0, 1] pixels served
+    reference = np.clip(reference / 2 + 0.5, 0, 1).astype(np.float64)
+    quantized = np.clip(quantized / 2 + 0.5, 0, 1).astype(np.float64)
+    mse = np.mean((reference - quantized) ** 2, axis=(1, 2, 3))
+    return 10 * np.log10(1 / np.maximum(mse, 1e-10))
+
+
+def compare(fp32_path, int8_path, feeds, output_name, metric):
+    """Measures the int8 model against the fp32 one on the CPU.
+
+    `metric` is "cosine" for embeddings and "psnr" for decoded images.
+    """
+    reference, fp32_seconds = _run(_cpu_session(fp32_path), feeds, output_name)
+    quantized, int8_seconds = _run(_cpu_session(int8_path), feeds, output_name)
+    reference = np.concatenate(reference)
+    quantized = np.concatenate(quantized)
+
+    fp32_bytes = os.path.getsize(fp32_path)
+    int8_bytes = os.path.getsize(int8_path)
+    report = {
+        "fp32_bytes": fp32_bytes,
+        "int8_bytes": int8_bytes,
+        "size_reduction": round(fp32_bytes / int8_bytes, 2),
+        "fp32_cpu_ms": round(1000 * fp32_seconds, 2),
+        "int8_cpu_ms": round(1000 * int8_seconds, 2),
+    }
+    if metric == "cosine":
+        similarity = _cosine_similarity(reference, quantized)
+        report["min_cosine_similarity"] = round(float(similarity.min()), 5)
+        report["mean_cosine_similarity"] = round(float(similarity.mean()), 5)
+    elif metric == "psnr":
+        psnr = _psnr(reference, quantized)
+        report["min_psnr_db"] = round(float(psnr.min()), 2)
+        report["mean_psnr_db"] = round(float(psnr.mean()), 2)
+    return report
@@ -0,0 +1,118 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+
+import torch
+from diffusers import UNet2DConditionModel
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "backend"))
+
+from attention_backends import (  # noqa: E402
+    ATTENTION_BACKENDS,
+    resolve_attention_backend,
+    set_attention_backend,
+)
+from denoising_loop import tiny_unet, timed  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare the speed and peak memory of the attention backends "
+        "of the unet per resolution"
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    # a Hub model with a unet subfolder, a tiny random unet by default
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument(
+        "--backends",
+        type=str,
+        nargs="+",
+        default=[backend for backend in ATTENTION_BACKENDS if backend != "auto"],
+    )
+    # image resolutions in pixels, the latents are 8 times smaller
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[256, 512])
+    parser.add_argument("--batch_size", type=int, default=1)
+    # time a training step with a backward pass instead of inference
+    parser.add_argument("--train", action="store_true")
+    parser.add_argument("--repeats", type=int, default=3)
+
+    return parser.parse_args()
+
+
+def load_unet(model, device):
+    if model is None:
+        return tiny_unet().to(device)
+    return UNet2DConditionModel.from_pretrained(
+        model,
+        subfolder="unet",
+        torch_dtype=torch.float16 if device.type == "cuda" else torch.float32,
+    ).to(device)
+
+
+def peak_memory_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def run(backend, resolution, args):
+    # runs in its own process, so the peak memory is that of this backend alone
+    device = torch.device(args.device)
+    unet = load_unet(args.model, device)
+    set_attention_backend(unet, backend)
+
+    latent_size = resolution // 8
+    sample = torch.randn(
+        (args.batch_size, unet.config.in_channels, latent_size, latent_size),
+        dtype=unet.dtype,
+        device=device,
+    )
+    timestep = torch.tensor(999, device=device)
+    encoder_hidden_states = torch.randn(
+        (args.batch_size, 77, unet.config.cross_attention_dim),
+        dtype=unet.dtype,
+        device=device,
+    )
+
+    def step():
+        if args.train:
+            unet(sample, timestep, encoder_hidden_states).sample.mean().backward()
+        else:
+            with torch.inference_mode():
+                unet(sample, timestep, encoder_hidden_states)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    memory_before = peak_memory_mb(device)
+    seconds = timed(step, device, args.repeats)
+    return {
+        "backend": backend,
+        "resolution": resolution,
+        "ms": 1000 * seconds,
+        "peak_memory_mb": peak_memory_mb(device) - memory_before,
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device(args.device)
+    backends = []
+    for backend in args.backends:
+        try:
+            backend = resolve_attention_backend(backend, device)
+        except ValueError as e:
+            print(f"skipping {backend}: {e}")
+            continue
+        if backend not in backends:
+            backends.append(backend)
+
+    context = multiprocessing.get_context("spawn")
+    for resolution in args.resolutions:
+        for backend in backends:
+            with context.Pool(1) as pool:
+                report = pool.apply(run, (backend, resolution, args))
+            print(json.dumps(report))
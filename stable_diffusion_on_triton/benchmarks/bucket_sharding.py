@@ -0,0 +1,82 @@
+import argparse
+import os
+import random
+import sys
+from collections import Counter
+
+from accelerate.data_loader import BatchSamplerShard
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "tasks"))
+
+from buckets import BucketBatchSampler  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check that the bucket batches fine-tuning uses split evenly "
+        "across processes"
+    )
+    parser.add_argument("--num_processes", type=int, nargs="+", default=[1, 2, 5])
+    parser.add_argument("--configs", type=int, default=200)
+
+    return parser.parse_args()
+
+
+def check(buckets, batch_size, num_processes):
+    # the batches every process draws once accelerate has sharded the sampler
+    shards = [
+        BatchSamplerShard(
+            BucketBatchSampler(buckets, batch_size, seed=0, drop_last=True),
+            num_processes,
+            rank,
+        )
+        for rank in range(num_processes)
+    ]
+    batches = [list(shard) for shard in shards]
+
+    errors = []
+    if len({len(rank_batches) for rank_batches in batches}) > 1:
+        errors.append(f"batches per process {[len(b) for b in batches]}")
+    if [len(shard) for shard in shards] != [len(b) for b in batches]:
+        errors.append(
+            f"len {[len(shard) for shard in shards]} "
+            f"but drew {[len(b) for b in batches]}"
+        )
+    for rank_batches in batches:
+        for batch in rank_batches:
+            if len({buckets[index] for index in batch}) > 1:
+                errors.append(f"batch {batch} mixes buckets")
+    seen = Counter(
+        index for rank_batches in batches for b in rank_batches for index in b
+    )
+    if any(count > 1 for count in seen.values()):
+        errors.append("samples drawn more than once")
+    # only the remainder of each bucket that doesn't fill a batch is dropped
+    expected = sum(
+        count // batch_size * batch_size for count in Counter(buckets).values()
+    )
+    if len(seen) < expected - batch_size * (num_processes - 1):
+        errors.append(f"drew {len(seen)} of {expected} samples")
+    return errors
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    failed = 0
+    for config in range(args.configs):
+        rng = random.Random(config)
+        buckets = [(64 * rng.randint(1, 6), 64) for _ in range(rng.randint(1, 120))]
+        batch_size = rng.randint(1, 6)
+        for num_processes in args.num_processes:
+            errors = check(buckets, batch_size, num_processes)
+            if errors:
+                failed += 1
+                print(
+                    f"{len(buckets)} samples, batch size {batch_size}, "
+                    f"{num_processes} processes: {'; '.join(errors)}"
+                )
+
+    print(f"{failed} failing configurations")
+    if failed:
+        sys.exit("the bucket batches don't split evenly across processes")
@@ -0,0 +1,123 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import torch
+from safetensors.torch import save_file
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "tasks"))
+
+from build_cache import (  # noqa: E402
+    ENGINE_COMPONENTS,
+    hash_component_keys,
+    hash_lora_weights,
+)
+
+SHARED = {
+    "base_revision": "0" * 40,
+    "export_files": ["1" * 64, "2" * 64],
+    "toolchain": {"torch": "2.1.0", "tensorrt": "8.6.1"},
+}
+ENGINE_TARGET = {"tensorrt": "8601", "compute_capability": "7.5", "gpu": "Tesla T4"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check which build cache keys change with the inputs of "
+        "the optimization task"
+    )
+    parser.add_argument("--quantization", default="dynamic")
+
+    return parser.parse_args()
+
+
+def lora_digests(text_encoder=0.0, unet=0.0):
+    """Hashes LoRA weights whose text encoder and unet tensors are filled
+    with the given values."""
+    weights = {
+        "text_encoder.lora.down.weight": torch.full((4, 8), text_encoder),
+        "unet.lora.down.weight": torch.full((4, 8), unet),
+        "unet.lora.up.weight": torch.zeros(8, 4),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "pytorch_lora_weights.safetensors")
+        save_file(weights, path)
+        return hash_lora_weights(path)
+
+
+def changed(base, **inputs):
+    """Returns the components whose key differs from `base` for `inputs`."""
+    kwargs = dict(
+        shared=SHARED,
+        lora=lora_digests(),
+        quantization=base["quantization"],
+        engine_target=ENGINE_TARGET,
+    )
+    kwargs.update(inputs)
+    keys = hash_component_keys(**kwargs)
+    return {
+        component for component, key in keys.items() if key != base["keys"][component]
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    base = {
+        "quantization": args.quantization,
+        "keys": hash_component_keys(
+            SHARED, lora_digests(), args.quantization, ENGINE_TARGET
+        ),
+    }
+    engines = set(ENGINE_COMPONENTS)
+    checks = {
+        "another TensorRT release": (
+            dict(engine_target=dict(ENGINE_TARGET, tensorrt="10003")),
+            engines,
+        ),
+        "another GPU architecture": (
+            dict(
+                engine_target=dict(
+                    ENGINE_TARGET, compute_capability="8.6", gpu="NVIDIA A10G"
+                )
+            ),
+            engines,
+        ),
+        "another GPU of the same architecture": (
+            dict(engine_target=dict(ENGINE_TARGET, gpu="NVIDIA T4G")),
+            engines,
+        ),
+        "another unet LoRA": (dict(lora=lora_digests(unet=1.0)), {"unet", "vae_int8"}),
+        # the int8 vae is calibrated on what the text encoder and unet generate
+        "another text encoder LoRA": (
+            dict(lora=lora_digests(text_encoder=1.0)),
+            {"text_encoder", "text_encoder_int8", "vae_int8"},
+        ),
+        "another base revision": (
+            dict(shared=dict(SHARED, base_revision="6" * 40)),
+            set(base["keys"]),
+        ),
+    }
+
+    failed = False
+    for name, (inputs, expected) in checks.items():
+        # the int8 components are only keyed when they're built
+        expected &= set(base["keys"])
+        components = changed(base, **inputs)
+        if components != expected:
+            failed = True
+            print(f"{name}: changed {sorted(components)}, expected {sorted(expected)}")
+        else:
+            print(f"{name}: ok")
+
+    try:
+        hash_component_keys(SHARED, lora_digests(), args.quantization)
+    except ValueError:
+        print("no engine target: rejected")
+    else:
+        failed = True
+        print("no engine target: accepted")
+
+    if failed:
+        sys.exit("the build cache keys don't follow their inputs")
@@ -0,0 +1,82 @@
+import argparse
+import os
+import sys
+import tempfile
+
+import torch
+from accelerate import Accelerator
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "tasks"))
+
+from checkpoints import AsyncCheckpointer  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check which checkpoints the asynchronous checkpointer keeps "
+        "for each checkpoints_total_limit"
+    )
+    parser.add_argument("--steps", type=int, default=12)
+
+    return parser.parse_args()
+
+
+def save_checkpoints(output_dir, total_limit, steps):
+    # a full checkpoint on even steps and a LoRA-only one on odd steps, after
+    # the leftovers of an interrupted run
+    os.makedirs(os.path.join(output_dir, "logs"))
+    os.makedirs(os.path.join(output_dir, ".tmp-checkpoint-3"))
+
+    accelerator = Accelerator(cpu=True)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.Linear(4, 4))
+    model[0].requires_grad_(False)
+    optimizer = torch.optim.AdamW(model[1].parameters())
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    model, optimizer, lr_scheduler = accelerator.prepare(model, optimizer, lr_scheduler)
+
+    checkpointer = AsyncCheckpointer(output_dir, total_limit)
+    for step in range(1, steps + 1):
+        lora_state_dict = {"unet.lora.weight": model[1].weight.detach()}
+        if step % 2 == 0:
+            checkpointer.save_state(
+                step, accelerator, model, optimizer, lr_scheduler, lora_state_dict
+            )
+        else:
+            checkpointer.save_lora(step, lora_state_dict)
+    checkpointer.wait()
+    return sorted(os.listdir(output_dir))
+
+
+def expected(total_limit, steps):
+    full = [f"checkpoint-{step}" for step in range(2, steps + 1, 2)]
+    lora = [f"lora-{step}" for step in range(1, steps + 1, 2)]
+    if total_limit is not None:
+        # numerically, so checkpoint-10 is newer than checkpoint-8
+        full, lora = full[-total_limit:], lora[-total_limit:]
+    return sorted(full + lora + ["logs", ".tmp-checkpoint-3"])
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    failed = False
+    for total_limit in [None, 1, 2, 3, args.steps]:
+        with tempfile.TemporaryDirectory() as output_dir:
+            kept = save_checkpoints(output_dir, total_limit, args.steps)
+        if kept != expected(total_limit, args.steps):
+            failed = True
+            print(f"total_limit={total_limit}: kept {kept}")
+        else:
+            print(f"total_limit={total_limit}: ok")
+
+    for total_limit in [0, -1]:
+        try:
+            AsyncCheckpointer(tempfile.gettempdir(), total_limit)
+        except ValueError:
+            print(f"total_limit={total_limit}: rejected")
+        else:
+            failed = True
+            print(f"total_limit={total_limit}: accepted")
+
+    if failed:
+        sys.exit("the checkpointer kept the wrong checkpoints")
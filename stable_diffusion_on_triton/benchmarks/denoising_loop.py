@@ -0,0 +1,165 @@
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+import torch
+from diffusers import LMSDiscreteScheduler, UNet2DConditionModel
+
+sys.path.append(
+    os.path.join(os.path.dirname(__file__), os.pardir, "backend", "pipeline", "1")
+)
+
+from denoising import CUDAGraphUNet, denoise, unet_step  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare per-step latency of the denoising loops on a tiny UNet"
+    )
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--steps", type=int, default=50)
+    # small latents keep the unet cheap, so the loop overhead dominates on a cpu
+    parser.add_argument("--latent_size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--cuda_graphs", action="store_true")
+
+    return parser.parse_args()
+
+
+def tiny_unet():
+    # randomly initialized, so the benchmark needs neither weights nor a GPU
+    torch.manual_seed(0)
+    return UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+    )
+
+
+def scheduler():
+    return LMSDiscreteScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        num_train_timesteps=1000,
+    )
+
+
+def legacy_loop(unet, scheduler, text_embeddings, batch_size, steps, size, device):
+    # the loop the pipeline model used to run: host-side latents, a fresh
+    # autocast context and shape prints on every step
+    latents = torch.randn((batch_size, unet.config.in_channels, size, size)).to(device)
+    scheduler.set_timesteps(steps)
+    latents = latents * scheduler.sigmas[0]
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i, t in enumerate(scheduler.timesteps):
+            latent_model_input = torch.cat([latents] * 2)
+            latent_model_input = scheduler.scale_model_input(latent_model_input, t)
+            print("================")
+            print(latent_model_input.shape)
+            print(text_embeddings.shape)
+
+            with torch.no_grad(), torch.autocast(
+                device.type, enabled=device.type == "cuda"
+            ):
+                noise_pred = unet(
+                    latent_model_input, t, encoder_hidden_states=text_embeddings
+                ).sample
+
+            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+            noise_pred = noise_pred_uncond + 7.5 * (noise_pred_text - noise_pred_uncond)
+
+            latents = scheduler.step(
+                noise_pred, scheduler.timesteps[i], latents
+            ).prev_sample
+
+    return latents
+
+
+def lean_loop(unet, step, scheduler, text_embeddings, batch_size, steps, size, device):
+    scheduler.set_timesteps(steps, device=device)
+    with torch.inference_mode():
+        latents = torch.randn(
+            (batch_size, unet.config.in_channels, size, size), device=device
+        )
+        return denoise(step, scheduler, latents, text_embeddings, 7.5, dtype=unet.dtype)
+
+
+def timed(fn, device, repeats):
+    # warm up once, then keep the fastest run
+    fn()
+    timings = []
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device(args.device)
+
+    unet = tiny_unet().to(device)
+    text_embeddings = torch.randn(
+        (2 * args.batch_size, 77, unet.config.cross_attention_dim), device=device
+    )
+
+    step = unet_step(unet)
+    if args.cuda_graphs:
+        step = CUDAGraphUNet(
+            unet,
+            sample=torch.zeros(
+                (
+                    2 * args.batch_size,
+                    unet.config.in_channels,
+                    args.latent_size,
+                    args.latent_size,
+                ),
+                device=device,
+            ),
+            timestep=torch.zeros((), device=device),
+            encoder_hidden_states=text_embeddings,
+        )
+
+    legacy = timed(
+        lambda: legacy_loop(
+            unet,
+            scheduler(),
+            text_embeddings,
+            args.batch_size,
+            args.steps,
+            args.latent_size,
+            device,
+        ),
+        device,
+        args.repeats,
+    )
+    lean = timed(
+        lambda: lean_loop(
+            unet,
+            step,
+            scheduler(),
+            text_embeddings,
+            args.batch_size,
+            args.steps,
+            args.latent_size,
+            device,
+        ),
+        device,
+        args.repeats,
+    )
+
+    print(f"legacy loop: {1000 * legacy / args.steps:.2f} ms/step")
+    print(f"lean loop:   {1000 * lean / args.steps:.2f} ms/step")
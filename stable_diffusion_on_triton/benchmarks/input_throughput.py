@@ -0,0 +1,135 @@
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "tasks"))
+
+from input_pipeline import CropToSize, decode_image, normalize_batch  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measure how many training images per second the input "
+        "pipeline delivers, without a model"
+    )
+    # a Hub dataset with an image column, random jpegs of mixed sizes by default
+    parser.add_argument("--dataset", type=str, default=None)
+    parser.add_argument("--image_column", type=str, default="image")
+    parser.add_argument("--num_images", type=int, default=256)
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 2, 4])
+    parser.add_argument("--device", type=str, default="cpu")
+
+    return parser.parse_args()
+
+
+def random_images(num_images):
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(num_images):
+        width, height = rng.integers(384, 1024, size=2)
+        # smooth noise compresses like a photo rather than like static
+        small = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((width, height), Image.BILINEAR)
+        data = io.BytesIO()
+        image.save(data, format="JPEG", quality=90)
+        images.append({"bytes": data.getvalue(), "path": None})
+    return images
+
+
+def hub_images(name, image_column, num_images):
+    import datasets
+
+    dataset = datasets.load_dataset(name, split=f"train[:{num_images}]")
+    dataset = dataset.cast_column(image_column, datasets.Image(decode=False))
+    return dataset[image_column]
+
+
+class EncodedImages(torch.utils.data.Dataset):
+    def __init__(self, images, transform):
+        self.images = images
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return self.transform(self.images[index])
+
+
+def pil_pipeline(resolution):
+    # the per-example PIL transforms the training task used before
+    train_transforms = transforms.Compose(
+        [
+            transforms.Resize(
+                resolution, interpolation=transforms.InterpolationMode.BILINEAR
+            ),
+            transforms.RandomCrop(resolution),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize([0.5], [0.5]),
+        ]
+    )
+
+    def transform(image):
+        with Image.open(io.BytesIO(image["bytes"])) as f:
+            return train_transforms(f.convert("RGB"))
+
+    return transform, lambda batch: batch
+
+
+def uint8_pipeline(resolution):
+    crop = CropToSize((resolution, resolution), center_crop=False)
+    return (
+        lambda image: crop(decode_image(image)),
+        lambda batch: normalize_batch(batch, random_flip=True, dtype=torch.float16),
+    )
+
+
+def images_per_second(dataloader, normalize, device):
+    batches = iter(dataloader)
+    # the first batch pays for starting the workers
+    normalize(next(batches).to(device))
+
+    count = 0
+    start = time.perf_counter()
+    for batch in batches:
+        normalize(batch.to(device, non_blocking=True))
+        count += len(batch)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device(args.device)
+
+    if args.dataset is None:
+        images = random_images(args.num_images)
+    else:
+        images = hub_images(args.dataset, args.image_column, args.num_images)
+
+    print(f"{'pipeline':>8} | {'workers':>7} | {'images/s':>8}")
+    for name, pipeline in (("pil", pil_pipeline), ("uint8", uint8_pipeline)):
+        transform, normalize = pipeline(args.resolution)
+        for num_workers in args.num_workers:
+            dataloader = torch.utils.data.DataLoader(
+                EncodedImages(images, transform),
+                batch_size=args.batch_size,
+                shuffle=True,
+                num_workers=num_workers,
+                persistent_workers=num_workers > 0,
+                prefetch_factor=2 if num_workers > 0 else None,
+                pin_memory=device.type == "cuda",
+            )
+            throughput = images_per_second(dataloader, normalize, device)
+            print(f"{name:>8} | {num_workers:>7} | {throughput:>8.1f}")
@@ -0,0 +1,80 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tritonclient.http as httpclient
+from tritonclient.utils import np_to_triton_dtype
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measure pipeline throughput against a running Triton server"
+    )
+    parser.add_argument("--url", type=str, default="localhost:8000")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--prompt", type=str, default="cute dragon creature")
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="encoded_image",
+        choices=["generated_image", "encoded_image"],
+    )
+
+    return parser.parse_args()
+
+
+def infer(url, batch_size, prompt, output):
+    # tritonclient's http client isn't thread-safe, so every request gets its own
+    client = httpclient.InferenceServerClient(
+        url=url, connection_timeout=600, network_timeout=600
+    )
+
+    text_obj = np.array([prompt] * batch_size, dtype="object").reshape((-1, 1))
+    inputs = [
+        httpclient.InferInput(
+            "prompt", text_obj.shape, np_to_triton_dtype(text_obj.dtype)
+        )
+    ]
+    inputs[0].set_data_from_numpy(text_obj)
+
+    client.infer(
+        "pipeline",
+        inputs,
+        outputs=[httpclient.InferRequestedOutput(output, binary_data=True)],
+    )
+
+
+def run_benchmark(url, batch_size, iterations, concurrency, prompt, output):
+    # warm up
+    infer(url, batch_size, prompt, output)
+
+    num_requests = iterations * concurrency
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(
+            executor.map(
+                lambda _: infer(url, batch_size, prompt, output), range(num_requests)
+            )
+        )
+    elapsed = time.perf_counter() - start
+
+    return batch_size * num_requests / elapsed, elapsed / num_requests
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    print(f"{'batch size':>10} | {'images/s':>8} | {'s/request':>9}")
+    for batch_size in args.batch_sizes:
+        throughput, latency = run_benchmark(
+            url=args.url,
+            batch_size=batch_size,
+            iterations=args.iterations,
+            concurrency=args.concurrency,
+            prompt=args.prompt,
+            output=args.output,
+        )
+        print(f"{batch_size:>10} | {throughput:>8.2f} | {latency:>9.2f}")
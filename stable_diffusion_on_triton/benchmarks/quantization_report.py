@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+from diffusers import AutoencoderKL
+from transformers import CLIPTextModel, CLIPTokenizer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "backend"))
+
+from export import export_text_encoder, export_vae  # noqa: E402
+from quantize import CALIBRATION_PROMPTS, compare, quantize  # noqa: E402
+from text_encoder_parity import tiny_text_encoder  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Quantize the text encoder and VAE to int8 and compare them "
+        "against fp32 on the CPU"
+    )
+    # a Hub model with text_encoder, tokenizer and vae subfolders, tiny random
+    # models by default
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument("--modes", type=str, nargs="+", default=["dynamic", "static"])
+    parser.add_argument("--min_cosine_similarity", type=float, default=0.99)
+    parser.add_argument("--min_psnr", type=float, default=25.0)
+
+    return parser.parse_args()
+
+
+def tiny_vae():
+    torch.manual_seed(0)
+    return AutoencoderKL(
+        block_out_channels=(32, 64),
+        down_block_types=("DownEncoderBlock2D",) * 2,
+        up_block_types=("UpDecoderBlock2D",) * 2,
+        latent_channels=4,
+        sample_size=32,
+    )
+
+
+def text_encoder_feeds(text_encoder, tokenizer):
+    sequence_length = text_encoder.config.max_position_embeddings
+    if tokenizer is None:
+        generator = torch.Generator().manual_seed(0)
+        input_ids = torch.randint(
+            0,
+            text_encoder.config.vocab_size,
+            (len(CALIBRATION_PROMPTS), sequence_length),
+            generator=generator,
+        ).numpy()
+    else:
+        input_ids = tokenizer(
+            CALIBRATION_PROMPTS,
+            padding="max_length",
+            max_length=sequence_length,
+            truncation=True,
+            return_tensors="np",
+        ).input_ids
+    return [{"input_ids": ids[None].astype(np.int32)} for ids in input_ids]
+
+
+def vae_feeds(vae, latent_size):
+    # random latents stand in for the ones the pipeline generates
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn(
+        (
+            len(CALIBRATION_PROMPTS),
+            vae.config.latent_channels,
+            latent_size,
+            latent_size,
+        ),
+        generator=generator,
+    )
+    return [{"latent_sample": latent[None].numpy()} for latent in latents]
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.model is None:
+        text_encoder, tokenizer, vae = tiny_text_encoder(), None, tiny_vae()
+        latent_size = 16
+    else:
+        text_encoder = CLIPTextModel.from_pretrained(
+            args.model, subfolder="text_encoder"
+        )
+        tokenizer = CLIPTokenizer.from_pretrained(args.model, subfolder="tokenizer")
+        vae = AutoencoderKL.from_pretrained(args.model, subfolder="vae")
+        latent_size = 64
+    text_encoder, vae = text_encoder.eval(), vae.eval()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        text_encoder_path = os.path.join(tmp_dir, "text_encoder.onnx")
+        vae_path = os.path.join(tmp_dir, "vae.onnx")
+        export_text_encoder(
+            text_encoder,
+            text_encoder_path,
+            text_encoder.config.max_position_embeddings,
+            float16=False,
+        )
+        export_vae(vae, vae_path, latent_size)
+        components = {
+            "text_encoder": (
+                text_encoder_path,
+                text_encoder_feeds(text_encoder, tokenizer),
+                "last_hidden_state",
+                "cosine",
+            ),
+            "vae": (vae_path, vae_feeds(vae, latent_size), "sample", "psnr"),
+        }
+
+        for mode in args.modes:
+            for name, (fp32_path, feeds, output_name, metric) in components.items():
+                int8_path = os.path.join(tmp_dir, f"{name}_{mode}.onnx")
+                quantize(fp32_path, int8_path, mode, feeds)
+                report = compare(fp32_path, int8_path, feeds, output_name, metric)
+                print(f"{name} {mode}: {json.dumps(report)}")
+
+                if metric == "cosine":
+                    failed |= (
+                        report["min_cosine_similarity"] < args.min_cosine_similarity
+                    )
+                else:
+                    failed |= report["min_psnr_db"] < args.min_psnr
+
+    if failed:
+        sys.exit("an int8 model is below the similarity thresholds")
@@ -0,0 +1,127 @@
+import argparse
+import collections
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from transformers import CLIPTextConfig, CLIPTextModel
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "backend"))
+
+from export import export_text_encoder  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check the exported text encoder against PyTorch with ONNX Runtime"
+    )
+    # a Hub model with a text_encoder subfolder, a tiny random encoder by default
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 8])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-3)
+    # fp16 graphs need the CUDA execution provider
+    parser.add_argument("--float16", action="store_true")
+
+    return parser.parse_args()
+
+
+def tiny_text_encoder():
+    torch.manual_seed(0)
+    return CLIPTextModel(
+        CLIPTextConfig(
+            vocab_size=1000,
+            hidden_size=64,
+            intermediate_size=128,
+            num_attention_heads=4,
+            num_hidden_layers=2,
+            max_position_embeddings=77,
+        )
+    )
+
+
+def timed(fn, repeats):
+    fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    import onnx
+    import onnxruntime as ort
+
+    args = parse_args()
+    device = "cuda" if args.float16 else "cpu"
+
+    if args.model is None:
+        text_encoder = tiny_text_encoder()
+    else:
+        text_encoder = CLIPTextModel.from_pretrained(
+            args.model, subfolder="text_encoder"
+        )
+    text_encoder = text_encoder.eval().to(device)
+    sequence_length = text_encoder.config.max_position_embeddings
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        onnx_path = os.path.join(tmp_dir, "model.onnx")
+        export_text_encoder(
+            text_encoder, onnx_path, sequence_length, float16=args.float16
+        )
+        ops = collections.Counter(
+            node.op_type for node in onnx.load(onnx_path).graph.node
+        )
+        session = ort.InferenceSession(
+            onnx_path,
+            providers=[
+                "CUDAExecutionProvider" if args.float16 else "CPUExecutionProvider"
+            ],
+        )
+    print(
+        "fused ops:",
+        ", ".join(
+            f"{op} x{ops[op]}"
+            for op in ("Attention", "SkipLayerNormalization", "LayerNormalization")
+            if ops[op]
+        ),
+    )
+
+    failed = False
+    print(
+        f"{'batch size':>10} | {'max abs diff':>12} | {'torch ms':>8} | {'onnx ms':>8}"
+    )
+    for batch_size in args.batch_sizes:
+        generator = torch.Generator().manual_seed(batch_size)
+        input_ids = torch.randint(
+            0,
+            text_encoder.config.vocab_size,
+            (batch_size, sequence_length),
+            generator=generator,
+            dtype=torch.int32,
+        )
+
+        with torch.inference_mode():
+            expected = text_encoder(input_ids.to(device))[0].float().cpu().numpy()
+            torch_time = timed(lambda: text_encoder(input_ids.to(device)), args.repeats)
+
+        def run_onnx():
+            return session.run(["last_hidden_state"], {"input_ids": input_ids.numpy()})
+
+        actual = run_onnx()[0].astype(np.float32)
+        onnx_time = timed(run_onnx, args.repeats)
+
+        diff = np.abs(actual - expected).max()
+        failed |= diff > args.atol
+        print(
+            f"{batch_size:>10} | {diff:>12.2e} | "
+            f"{1000 * torch_time:>8.2f} | {1000 * onnx_time:>8.2f}"
+        )
+
+    if failed:
+        sys.exit(f"exported text encoder differs by more than {args.atol}")
@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "tasks"))
+
+from telemetry import StepTelemetry, count_tokens  # noqa: E402
+
+# CLIP's begin and end of text tokens, the latter also pads
+BOS, EOS = 49406, 49407
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check that the fine-tuning telemetry counts the caption "
+        "tokens without their padding"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--max_length", type=int, default=77)
+
+    return parser.parse_args()
+
+
+def padded_captions(lengths, max_length, device):
+    """Returns token ids like the tokenizer's, captions of `lengths` tokens
+    between the begin and end of text tokens, padded to `max_length`."""
+    input_ids = torch.full((len(lengths), max_length), EOS, device=device)
+    for row, length in enumerate(lengths):
+        input_ids[row, 0] = BOS
+        input_ids[row, 1 : length + 1] = torch.arange(length, device=device) + 1000
+    return input_ids
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device(args.device)
+
+    telemetry = StepTelemetry(device)
+    expected = 0
+    for step in range(args.steps):
+        lengths = [step + 1, 10, args.max_length - 2]
+        input_ids = padded_captions(lengths, args.max_length, device)
+        tokens = count_tokens(input_ids, EOS)
+        if tokens.device != device:
+            sys.exit(f"counted the tokens on {tokens.device}")
+        telemetry.end_step(len(lengths), tokens)
+        # the begin of text token of every caption, not its end of text token
+        expected += sum(lengths) + len(lengths)
+
+    telemetry.report()
+    print(f"counted {int(telemetry.tokens)} tokens, expected {expected}")
+    if int(telemetry.tokens) != expected:
+        sys.exit("the padding was counted as caption tokens")
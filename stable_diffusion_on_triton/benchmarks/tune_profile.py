@@ -0,0 +1,147 @@
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tritonclient.http as httpclient
+from tritonclient.utils import InferenceServerException
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "tasks"))
+
+from pipeline_throughput import infer  # noqa: E402
+from tuning import (  # noqa: E402
+    TUNING_PROFILE_FILE,
+    ModelTuning,
+    TuningProfile,
+    write_model_configs,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Sweep tuning profiles on the local GPU and keep the fastest"
+    )
+    parser.add_argument("--model_repository", type=str, required=True)
+    parser.add_argument("--tritonserver", type=str, default="tritonserver")
+    parser.add_argument("--pipeline_instances", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--component_instances", type=int, nargs="+", default=[1, 2])
+    parser.add_argument(
+        "--queue_delays", type=int, nargs="+", default=[0, 50000, 100000]
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--iterations", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=1)
+    # candidates whose mean request latency exceeds this many seconds are skipped
+    parser.add_argument("--max_latency", type=float, default=None)
+    parser.add_argument("--prompt", type=str, default="cute dragon creature")
+
+    return parser.parse_args()
+
+
+def candidate_profiles(pipeline_instances, component_instances, queue_delays):
+    for pipeline_count, component_count, delay in itertools.product(
+        pipeline_instances, component_instances, queue_delays
+    ):
+        profile = TuningProfile()
+        profile.models["pipeline"] = ModelTuning(
+            instance_count=pipeline_count,
+            preferred_batch_sizes=[4, 8],
+            max_queue_delay_microseconds=delay,
+        )
+        for name in ("text_encoder", "vae", "unet"):
+            profile.models[name].instance_count = component_count
+        yield profile
+
+
+def wait_until_ready(url, server, timeout=900):
+    client = httpclient.InferenceServerClient(url=url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("tritonserver exited before becoming ready")
+        try:
+            if client.is_server_ready():
+                return
+        except Exception:
+            pass
+        time.sleep(5)
+    raise TimeoutError("tritonserver did not become ready")
+
+
+def measure(args, url):
+    infer(url, args.batch_size, args.prompt, "encoded_image")
+
+    num_requests = args.iterations * args.concurrency
+    latencies = []
+
+    def timed_infer(_):
+        start = time.perf_counter()
+        infer(url, args.batch_size, args.prompt, "encoded_image")
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(timed_infer, range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    return args.batch_size * num_requests / elapsed, sum(latencies) / len(latencies)
+
+
+def run_candidate(args, profile, url="localhost:8000"):
+    write_model_configs(args.model_repository, profile)
+    server = subprocess.Popen(
+        [
+            args.tritonserver,
+            f"--model-repository={args.model_repository}",
+            "--cache-config=local,size=268435456",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_until_ready(url, server)
+        return measure(args, url)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    best = None
+    for profile in candidate_profiles(
+        args.pipeline_instances, args.component_instances, args.queue_delays
+    ):
+        pipeline = profile.models["pipeline"]
+        label = (
+            f"pipeline x{pipeline.instance_count}, "
+            f"components x{profile.models['vae'].instance_count}, "
+            f"delay {pipeline.max_queue_delay_microseconds}us"
+        )
+        try:
+            throughput, latency = run_candidate(args, profile)
+        except (RuntimeError, TimeoutError, InferenceServerException) as e:
+            # e.g. the instances don't fit into the GPU's memory or a model fails to load
+            print(f"{label}: failed, {e}")
+            continue
+        print(f"{label}: {throughput:.2f} images/s, {latency:.2f} s/request")
+
+        if args.max_latency is not None and latency > args.max_latency:
+            continue
+        if best is None or throughput > best[0]:
+            best = (throughput, profile)
+
+    if best is None:
+        sys.exit("no candidate profile met the constraints")
+
+    # leave the repository configured with the winner and record it next to the models
+    write_model_configs(args.model_repository, best[1])
+    print(
+        json.dumps(best[1].to_dict(), indent=2),
+        f"\nwritten to {os.path.join(args.model_repository, TUNING_PROFILE_FILE)}",
+    )
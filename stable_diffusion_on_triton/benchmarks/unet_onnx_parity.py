@@ -0,0 +1,97 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, "backend"))
+
+from denoising_loop import tiny_unet  # noqa: E402
+from export import export_unet  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check the exported UNet against PyTorch with ONNX Runtime on a CPU"
+    )
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--latent_size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-3)
+
+    return parser.parse_args()
+
+
+def unet_inputs(unet, batch_size, latent_size):
+    generator = torch.Generator().manual_seed(batch_size)
+    sample = torch.randn(
+        (batch_size, unet.config.in_channels, latent_size, latent_size),
+        generator=generator,
+    )
+    timestep = torch.full((batch_size,), 981.0)
+    encoder_hidden_states = torch.randn(
+        (batch_size, 77, unet.config.cross_attention_dim), generator=generator
+    )
+    return sample, timestep, encoder_hidden_states
+
+
+def timed(fn, repeats):
+    fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    import onnxruntime as ort
+
+    args = parse_args()
+
+    unet = tiny_unet().eval()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        onnx_path = os.path.join(tmp_dir, "unet.onnx")
+        export_unet(unet, onnx_path, latent_size=args.latent_size)
+        session = ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+
+    def run_onnx(sample, timestep, encoder_hidden_states):
+        return session.run(
+            ["out_sample"],
+            {
+                "sample": sample.numpy(),
+                "timestep": timestep.numpy(),
+                "encoder_hidden_states": encoder_hidden_states.numpy(),
+            },
+        )[0]
+
+    failed = False
+    print(
+        f"{'batch size':>10} | {'max abs diff':>12} | {'torch ms':>8} | {'onnx ms':>8}"
+    )
+    for batch_size in args.batch_sizes:
+        inputs = unet_inputs(unet, batch_size, args.latent_size)
+        with torch.inference_mode():
+            expected = unet(*inputs, return_dict=False)[0].numpy()
+            torch_time = timed(lambda: unet(*inputs, return_dict=False), args.repeats)
+        actual = run_onnx(*inputs)
+        onnx_time = timed(lambda: run_onnx(*inputs), args.repeats)
+
+        # every row of a batch must match the same row run on its own
+        rows = np.concatenate(
+            [run_onnx(*(x[i : i + 1] for x in inputs)) for i in range(batch_size)]
+        )
+
+        diff = max(np.abs(actual - expected).max(), np.abs(actual - rows).max())
+        failed |= diff > args.atol
+        print(
+            f"{batch_size:>10} | {diff:>12.2e} | "
+            f"{1000 * torch_time:>8.2f} | {1000 * onnx_time:>8.2f}"
+        )
+
+    if failed:
+        sys.exit(f"exported unet differs by more than {args.atol}")
@@ -13,7 +13,21 @@ inputs.append(
 )
 inputs[0].set_data_from_numpy(text_obj)
 
-outputs.append(httpclient.InferRequestedOutput("generated_image"))
+# optional sampling settings, the pipeline's defaults apply to any left out
+settings = {
+    "scheduler": np.array(["dpm++"], dtype="object").reshape((-1, 1)),
+    "num_inference_steps": np.array([[20]], dtype=np.int32),
+    "guidance_scale": np.array([[7.5]], dtype=np.float32),
+    "seed": np.array([[42]], dtype=np.int64),
+    "output_format": np.array(["jpeg"], dtype="object").reshape((-1, 1)),
+}
+for name, value in settings.items():
+    setting = httpclient.InferInput(name, value.shape, np_to_triton_dtype(value.dtype))
+    setting.set_data_from_numpy(value)
+    inputs.append(setting)
+
+# the compressed image is far smaller than the raw generated_image array
+outputs.append(httpclient.InferRequestedOutput("encoded_image"))
 
 request_body, header_length = httpclient.InferenceServerClient.generate_request_body(
     inputs, outputs=outputs
@@ -23,4 +37,4 @@ with open("inference_input.bin", "wb") as f:
     f.write(request_body)
 
 if __name__ == "__main__":
-    print(header_length)  # 173
+    print(header_length)
@@ -1,18 +1,33 @@
-import numpy as np
+import io
+import sys
+
 import tritonclient.http as httpclient
 from PIL import Image
 
 header_length_prefix = "application/vnd.sagemaker-triton.binary+json;json-header-size="
 
+# the response's content type, which holds the length of its json header, run
+# `aws s3api head-object --bucket stable-diffusion-sagemaker --key inference-output/output/<output-file> --query ContentType`
+# to get it
+content_type = sys.argv[1]
+if content_type.startswith(header_length_prefix):
+    header_length = int(content_type[len(header_length_prefix) :])
+else:
+    # a response without binary outputs is plain json
+    header_length = None
+
 # download the inference output file
 with open("inference_output.out", "rb") as f:
     content = f.read()
 
-# run this command `aws s3api head-object --bucket stable-diffusion-sagemaker --key inference-output/output/<output-file>` to get the response header length
 result = httpclient.InferenceServerClient.parse_response_body(
-    content, header_length=166
+    content, header_length=header_length
 )
 
-image_array = result.as_numpy("generated_image")
-image = Image.fromarray(np.squeeze(image_array))
-image.save("output.png")
+encoded_images = result.as_numpy("encoded_image")
+for index, encoded_image in enumerate(encoded_images.reshape(-1)):
+    # named after the format the request asked for
+    with Image.open(io.BytesIO(encoded_image)) as image:
+        extension = image.format.lower()
+    with open(f"output_{index}.{extension}", "wb") as f:
+        f.write(encoded_image)
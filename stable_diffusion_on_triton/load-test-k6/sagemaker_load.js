@@ -39,8 +39,9 @@ export const options = {
 
 
 export default function () {
-  // Load ShareGPT random example
-  const sample = '{"inputs":[{"name":"prompt","shape":[1,1],"datatype":"BYTES","parameters":{"binary_data_size":24}}],"outputs":[{"name":"generated_image","parameters":{"binary_data":true}}]}\x14\x00\x00\x00cute dragon creature';
+  // Load ShareGPT random example, the json header is followed by the binary prompt
+  const header = '{"inputs":[{"name":"prompt","shape":[1,1],"datatype":"BYTES","parameters":{"binary_data_size":24}}],"outputs":[{"name":"encoded_image","parameters":{"binary_data":true}}]}';
+  const sample = header + '\x14\x00\x00\x00cute dragon creature';
 
   /**
    * Create a signer instance with the AWS credentials.
@@ -62,7 +63,7 @@ export default function () {
    * https://k6.io/docs/javascript-api/jslib/aws/signaturev4/
    */
   const headers = {
-    'Content-Type': 'application/vnd.sagemaker-triton.binary+json;json-header-size=173',
+    'Content-Type': `application/vnd.sagemaker-triton.binary+json;json-header-size=${header.length}`,
   };
   if (INFERENCE_COMPONENT) {
     headers['X-Amzn-SageMaker-Inference-Component'] = INFERENCE_COMPONENT
@@ -0,0 +1,123 @@
+import io
+import math
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Sequence, Tuple
+
+import datasets
+import torch
+from PIL import Image
+
+# width and height in pixels
+Bucket = Tuple[int, int]
+
+
+def make_buckets(
+    resolution: int,
+    min_resolution: int = 256,
+    step: int = 64,
+    max_aspect_ratio: float = 2.0,
+) -> Dict[int, List[Bucket]]:
+    """Returns aspect ratio buckets in tiers of decreasing area.
+
+    Tier `t` holds buckets of at most t * t pixels with sides that are a
+    multiple of `step`, for tiers from `resolution` down to `min_resolution`.
+    """
+    buckets = {}
+    for tier in range(resolution, min_resolution - 1, -2 * step):
+        tier_buckets = set()
+        for width in range(step, int(tier * max_aspect_ratio) + 1, step):
+            height = tier * tier // width // step * step
+            if height >= step and max(width, height) <= max_aspect_ratio * min(
+                width, height
+            ):
+                tier_buckets.update([(width, height), (height, width)])
+        buckets[tier] = sorted(tier_buckets)
+    return buckets
+
+
+def assign_bucket(width: int, height: int, buckets: Dict[int, List[Bucket]]) -> Bucket:
+    # the largest tier the image covers without upscaling, the smallest otherwise,
+    # then the bucket in it closest to the image's aspect ratio
+    tier = max((t for t in buckets if t * t <= width * height), default=min(buckets))
+    return min(
+        buckets[tier],
+        key=lambda bucket: abs(math.log(bucket[0] / bucket[1] * height / width)),
+    )
+
+
+def image_sizes(dataset, image_column: str) -> List[Tuple[int, int]]:
+    # reads the sizes from the image headers without decoding the pixels
+    undecoded = dataset.cast_column(image_column, datasets.Image(decode=False))
+    sizes = []
+    for image in undecoded[image_column]:
+        source = image["path"] if image["bytes"] is None else io.BytesIO(image["bytes"])
+        with Image.open(source) as f:
+            sizes.append(f.size)
+    return sizes
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Yields batches of indices that share a bucket.
+
+    Batches are shuffled within and across buckets on every pass, starting from
+    `seed`, so every process draws the same batches in the same order.
+    """
+
+    def __init__(
+        self,
+        buckets: Sequence[Bucket],
+        batch_size: int,
+        seed: int = 0,
+        drop_last: bool = False,
+    ):
+        self.groups = defaultdict(list)
+        for index, bucket in enumerate(buckets):
+            self.groups[tuple(bucket)].append(index)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.rng = random.Random(seed)
+
+    def __iter__(self):
+        batches = []
+        for indices in self.groups.values():
+            indices = list(indices)
+            self.rng.shuffle(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start : start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        self.rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        round_ = math.floor if self.drop_last else math.ceil
+        return sum(
+            round_(len(indices) / self.batch_size) for indices in self.groups.values()
+        )
+
+
+class BucketThroughput:
+    """Accumulates the samples and wall time of the steps taken on each bucket."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.samples = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.last = time.perf_counter()
+
+    def step(self, bucket: Bucket, samples: int):
+        now = time.perf_counter()
+        self.samples[bucket] += samples
+        self.seconds[bucket] += now - self.last
+        self.last = now
+
+    def report(self) -> Dict[str, float]:
+        return {
+            f"bucket_{width}x{height}/samples_per_second": samples
+            / self.seconds[(width, height)]
+            for (width, height), samples in sorted(self.samples.items())
+        }
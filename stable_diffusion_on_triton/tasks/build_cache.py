@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import struct
+from importlib import metadata
+from typing import Dict, List, Optional
+
+import fsspec
+
+# files each component contributes to the model repository, relative to its root
+ARTIFACTS = {
+    "text_encoder": ["text_encoder/1/model.onnx"],
+    "vae": ["vae/1/model.plan"],
+    "unet": ["unet/1/model.plan", "pipeline/1/unet", "pipeline/1/tokenizer"],
+    "text_encoder_int8": [
+        "text_encoder_int8/1/model.onnx",
+        "text_encoder_int8/quantization_report.json",
+    ],
+    "vae_int8": ["vae_int8/1/model.onnx", "vae_int8/quantization_report.json"],
+}
+QUANTIZED_COMPONENTS = ("text_encoder_int8", "vae_int8")
+# TensorRT engines only deserialize with the TensorRT release and on the GPU
+# architecture they were built with
+ENGINE_COMPONENTS = ("vae", "unet")
+
+# prefixes of the LoRA tensors that each component is built from, the int8 vae
+# is calibrated on latents the fused text encoder and unet generate
+LORA_PREFIXES = {
+    "text_encoder": ("text_encoder.",),
+    "unet": ("unet.",),
+    "text_encoder_int8": ("text_encoder.",),
+    "vae_int8": ("text_encoder.", "unet."),
+}
+LORA_WEIGHTS = "pytorch_lora_weights.safetensors"
+
+TOOLCHAIN = ("torch", "diffusers", "transformers", "onnx", "tensorrt")
+
+# written last, so that interrupted uploads are never read back
+COMPLETE_MARKER = "COMPLETE"
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _toolchain_versions() -> Dict[str, str]:
+    versions = {}
+    for package in TOOLCHAIN:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def _base_revision(model_name: str) -> str:
+    from huggingface_hub import HfApi
+
+    return HfApi().model_info(model_name).sha
+
+
+def _lora_digests(repo_id: str) -> Dict[str, str]:
+    from huggingface_hub import hf_hub_download
+
+    return hash_lora_weights(hf_hub_download(repo_id, LORA_WEIGHTS))
+
+
+def hash_lora_weights(path: str) -> Dict[str, str]:
+    """Hashes the LoRA tensors in the safetensors file at `path` that each
+    component is built from."""
+    # straight from the safetensors layout: an 8 byte header length, a json
+    # header, then the raw tensor data
+    digests = {component: hashlib.sha256() for component in LORA_PREFIXES}
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        for name in sorted(header):
+            if name == "__metadata__":
+                continue
+            for component, prefixes in LORA_PREFIXES.items():
+                if name.startswith(prefixes):
+                    info = header[name]
+                    start, end = info["data_offsets"]
+                    f.seek(8 + header_size + start)
+                    digest = digests[component]
+                    digest.update(
+                        json.dumps([name, info["dtype"], info["shape"]]).encode()
+                    )
+                    digest.update(f.read(end - start))
+    return {component: digest.hexdigest() for component, digest in digests.items()}
+
+
+def component_keys(
+    model_name: str,
+    repo_id: str,
+    export_files: List[str],
+    quantization: str = "none",
+    engine_target: Optional[dict] = None,
+) -> Dict[str, str]:
+    """Returns a content hash per component of everything its artifacts are built from.
+
+    The export code stands in for the export settings, and the vae doesn't
+    depend on the LoRA at all, so a LoRA-only update keeps its key. The int8
+    components are only built, and keyed, when `quantization` isn't "none".
+    `engine_target` describes the TensorRT release and GPU the engines are
+    built for, see `export.engine_target`.
+    """
+    shared = {
+        "base_revision": _base_revision(model_name),
+        "export_files": [_sha256(path) for path in export_files],
+        "toolchain": _toolchain_versions(),
+    }
+    return hash_component_keys(
+        shared, _lora_digests(repo_id), quantization, engine_target
+    )
+
+
+def hash_component_keys(
+    shared: dict,
+    lora: Dict[str, str],
+    quantization: str = "none",
+    engine_target: Optional[dict] = None,
+) -> Dict[str, str]:
+    """Hashes the inputs of every component, given the ones they share and
+    the digests of the LoRA tensors fused into each."""
+    keys = {}
+    for component in ARTIFACTS:
+        inputs = dict(shared, component=component, lora=lora.get(component))
+        if component in QUANTIZED_COMPONENTS:
+            if quantization == "none":
+                continue
+            inputs["quantization"] = quantization
+        if component in ENGINE_COMPONENTS:
+            if engine_target is None:
+                raise ValueError(
+                    f"{component} is a TensorRT engine, pass engine_target"
+                )
+            inputs["engine_target"] = engine_target
+        keys[component] = hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode()
+        ).hexdigest()
+    return keys
+
+
+class BuildCache:
+    """Stores component artifacts under their keys in a local directory or blob store."""
+
+    def __init__(self, uri: str):
+        self.fs, self.root = fsspec.core.url_to_fs(uri)
+
+    def _entry(self, component: str, key: str) -> str:
+        return f"{self.root}/{component}-{key}"
+
+    def fetch(self, component: str, key: str, model_repository: str) -> bool:
+        entry = self._entry(component, key)
+        if not self.fs.exists(f"{entry}/{COMPLETE_MARKER}"):
+            return False
+
+        for path in ARTIFACTS[component]:
+            remote_path = f"{entry}/{path}"
+            local_path = os.path.join(model_repository, path)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            # a trailing slash copies a directory's contents rather than nesting it
+            if self.fs.isdir(remote_path):
+                remote_path += "/"
+            self.fs.get(remote_path, local_path, recursive=True)
+        return True
+
+    def store(self, component: str, key: str, model_repository: str):
+        entry = self._entry(component, key)
+        if self.fs.exists(f"{entry}/{COMPLETE_MARKER}"):
+            return
+
+        for path in ARTIFACTS[component]:
+            remote_path = f"{entry}/{path}"
+            local_path = os.path.join(model_repository, path)
+            self.fs.makedirs(remote_path.rsplit("/", 1)[0], exist_ok=True)
+            if os.path.isdir(local_path):
+                local_path += "/"
+            self.fs.put(local_path, remote_path, recursive=True)
+        self.fs.touch(f"{entry}/{COMPLETE_MARKER}")
@@ -0,0 +1,159 @@
+import copy
+import logging
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from accelerate.utils import (
+    OPTIMIZER_NAME,
+    RNG_STATE_NAME,
+    SAFE_WEIGHTS_NAME,
+    SCALER_NAME,
+    SCHEDULER_NAME,
+)
+from diffusers import StableDiffusionPipeline
+from safetensors.torch import save_file
+
+logger = logging.getLogger(__name__)
+
+
+def _to_host(state):
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: _to_host(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_host(value) for value in state)
+    return copy.deepcopy(state)
+
+
+def _rng_states() -> dict:
+    # the layout accelerator.load_state restores the random states from
+    states = {
+        "random_state": random.getstate(),
+        "numpy_random_seed": np.random.get_state(),
+        "torch_manual_seed": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["torch_cuda_manual_seed"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+class AsyncCheckpointer:
+    """Writes checkpoints from a background thread while training continues.
+
+    The training thread only copies the state to host memory. The writes run
+    one at a time in the order they were taken, each into a hidden directory
+    that is renamed once complete, followed by pruning the oldest checkpoints
+    of the same kind beyond `total_limit`.
+    """
+
+    def __init__(self, output_dir: str, total_limit: Optional[int] = None):
+        if total_limit is not None and total_limit < 1:
+            raise ValueError(
+                f"checkpoints_total_limit must be at least 1 or None, got {total_limit}"
+            )
+        self.output_dir = output_dir
+        self.total_limit = total_limit
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+        self.stalled_seconds = 0.0
+
+    def save_state(
+        self,
+        step: int,
+        accelerator,
+        model,
+        optimizer,
+        lr_scheduler,
+        lora_state_dict: Dict[str, torch.Tensor],
+    ) -> float:
+        """Takes a checkpoint that `accelerator.load_state(path, strict=False)`
+        resumes from, holding only the trainable weights of `model`.
+
+        Returns the seconds the training thread was stalled.
+        """
+        started = time.perf_counter()
+        files = {
+            SAFE_WEIGHTS_NAME: _to_host(
+                {
+                    name: param
+                    for name, param in model.named_parameters()
+                    if param.requires_grad
+                }
+            ),
+            f"{OPTIMIZER_NAME}.bin": _to_host(optimizer.state_dict()),
+            f"{SCHEDULER_NAME}.bin": _to_host(lr_scheduler.state_dict()),
+            f"{RNG_STATE_NAME}_{accelerator.process_index}.pkl": _rng_states(),
+        }
+        if accelerator.scaler is not None:
+            files[SCALER_NAME] = _to_host(accelerator.scaler.state_dict())
+        return self._submit(
+            "checkpoint", step, files, _to_host(lora_state_dict), started
+        )
+
+    def save_lora(self, step: int, lora_state_dict: Dict[str, torch.Tensor]) -> float:
+        """Takes a checkpoint of just the LoRA weights, cheap enough to take often.
+
+        Returns the seconds the training thread was stalled.
+        """
+        started = time.perf_counter()
+        return self._submit("lora", step, {}, _to_host(lora_state_dict), started)
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        self.executor.shutdown()
+
+    def _submit(self, kind, step, files, lora_state_dict, started):
+        # surface the errors of earlier writes on the training thread
+        for future in [future for future in self.futures if future.done()]:
+            future.result()
+            self.futures.remove(future)
+
+        self.futures.append(
+            self.executor.submit(self._write, kind, step, files, lora_state_dict)
+        )
+        stalled = time.perf_counter() - started
+        self.stalled_seconds += stalled
+        return stalled
+
+    def _write(self, kind, step, files, lora_state_dict):
+        started = time.perf_counter()
+        save_path = os.path.join(self.output_dir, f"{kind}-{step}")
+        tmp_path = os.path.join(self.output_dir, f".tmp-{kind}-{step}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        for name, state in files.items():
+            if name == SAFE_WEIGHTS_NAME:
+                save_file(
+                    state, os.path.join(tmp_path, name), metadata={"format": "pt"}
+                )
+            else:
+                torch.save(state, os.path.join(tmp_path, name))
+        StableDiffusionPipeline.save_lora_weights(
+            save_directory=tmp_path,
+            unet_lora_layers=lora_state_dict,
+            safe_serialization=True,
+        )
+        shutil.rmtree(save_path, ignore_errors=True)
+        os.rename(tmp_path, save_path)
+        logger.info(
+            f"Saved {kind} to {save_path} in {time.perf_counter() - started:.1f}s"
+        )
+
+        if self.total_limit is not None:
+            checkpoints = sorted(
+                (d for d in os.listdir(self.output_dir) if d.startswith(f"{kind}-")),
+                key=lambda d: int(d.split("-")[1]),
+            )
+            for checkpoint in checkpoints[: -self.total_limit]:
+                logger.info(f"Removing {checkpoint}")
+                shutil.rmtree(os.path.join(self.output_dir, checkpoint))
@@ -17,7 +17,7 @@ sd_deployment = create_sagemaker_deployment(
             "ModelDataUrl": "{inputs.model_path}",
             "Environment": {
                 "SAGEMAKER_TRITON_DEFAULT_MODEL_NAME": "pipeline",
-                "SAGEMAKER_TRITON_LOG_INFO": "false --load-model=text_encoder --load-model=vae",
+                "SAGEMAKER_TRITON_LOG_INFO": "false --load-model=text_encoder --load-model=vae --load-model=unet --cache-config=local,size=268435456",
             },
         },
         "ExecutionRoleArn": "{inputs.execution_role_arn}",
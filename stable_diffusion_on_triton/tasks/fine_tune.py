@@ -2,7 +2,6 @@ import logging
 import math
 import os
 import random
-import shutil
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional
@@ -29,7 +28,6 @@ from diffusers.optimization import get_scheduler
 from diffusers.training_utils import cast_training_params, compute_snr
 from diffusers.utils import convert_state_dict_to_diffusers
 from diffusers.utils.hub_utils import load_or_create_model_card, populate_model_card
-from diffusers.utils.import_utils import is_xformers_available
 from diffusers.utils.torch_utils import is_compiled_module
 from flytekit import ImageSpec, PodTemplate, Resources, Secret, task, workflow
 from flytekitplugins.kfpytorch import Elastic
@@ -42,13 +40,35 @@ from kubernetes.client.models import (
     V1VolumeMount,
 )
 from mashumaro.mixins.json import DataClassJSONMixin
-from packaging import version
 from peft import LoraConfig
 from peft.utils import get_peft_model_state_dict
-from torchvision import transforms
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
 
+from stable_diffusion_on_triton.backend.attention_backends import (
+    resolve_attention_backend,
+    set_attention_backend,
+)
+from stable_diffusion_on_triton.tasks.buckets import (
+    BucketBatchSampler,
+    BucketThroughput,
+    assign_bucket,
+    image_sizes,
+    make_buckets,
+)
+from stable_diffusion_on_triton.tasks.checkpoints import AsyncCheckpointer
+from stable_diffusion_on_triton.tasks.input_pipeline import (
+    CropToSize,
+    decode_image,
+    normalize_batch,
+)
+from stable_diffusion_on_triton.tasks.latent_cache import (
+    LatentCacheDataset,
+    build_latent_cache,
+    sample_latents,
+)
+from stable_diffusion_on_triton.tasks.telemetry import StepTelemetry, count_tokens
+
 logger = get_logger(__name__, log_level="INFO")
 torch._logging.set_logs(all=logging.DEBUG)
 
@@ -69,6 +89,7 @@ sd_finetuning_image = ImageSpec(
         "flytekit==1.11.0",
         "kubernetes==29.0.0",
         "huggingface-hub==0.22.2",
+        "tensorboard==2.16.2",
     ],
     cuda="12.2.2",
     cudnn="8",
@@ -107,7 +128,8 @@ class FineTuningArgs(DataClassJSONMixin):
     snr_gamma: Optional[float] = None
     use_8bit_adam: bool = False
     allow_tf32: bool = False
-    dataloader_num_workers: int = 0
+    dataloader_num_workers: int = 4
+    dataloader_prefetch_factor: int = 2
     adam_beta1: float = 0.9
     adam_beta2: float = 0.999
     adam_weight_decay: float = 1e-2
@@ -120,11 +142,34 @@ class FineTuningArgs(DataClassJSONMixin):
     local_rank: int = -1
     checkpointing_steps: int = 5000
     checkpoints_total_limit: Optional[int] = None
+    # additionally save just the LoRA weights every n steps, off by default
+    lora_checkpointing_steps: Optional[int] = None
     resume_from_checkpoint: Optional[str] = None
+    # one of auto, sdpa, xformers, sliced or vanilla
+    attention_backend: str = "auto"
+    # kept for existing launch configs, same as attention_backend="xformers"
     enable_xformers_memory_efficient_attention: bool = False
     noise_offset: float = 0
     rank: int = 4
     push_to_hub: bool = True
+    # encode the images and tokenize the captions once before training
+    cache_latents: bool = False
+    latent_cache_dir: str = "latent_cache"
+    latent_cache_batch_size: int = 8
+    # random crops cached per image unless center_crop is set, training picks
+    # one of them each time it sees the image
+    latent_cache_crops: int = 4
+    # batch images of a similar aspect ratio at their own size instead of
+    # cropping all of them to a `resolution` square
+    resolution_buckets: bool = False
+    min_bucket_resolution: int = 256
+    report_to: Optional[str] = "tensorboard"
+    # log step timings, throughput and peak memory every n optimization steps,
+    # 0 disables them
+    telemetry_steps: int = 50
+    # gathering the loss from every process each step synchronizes the device,
+    # without it the loss of each process is logged with the telemetry
+    gather_loss: bool = True
 
 
 DATASET_NAME_MAPPING = {
@@ -167,7 +212,7 @@ These are LoRA adaption weights for {base_model}. The weights were fine-tuned on
 
 @task(
     cache=True,
-    cache_version="1",
+    cache_version="2",
     container_image=sd_finetuning_image,
     requests=Resources(gpu="5", mem="30Gi", cpu="30"),
     task_config=Elastic(nnodes=1, nproc_per_node=5),  # distributed training
@@ -207,6 +252,9 @@ def stable_diffusion_finetuning(args: FineTuningArgs) -> str:
     if args.dataset_name is None and args.train_data_dir is None:
         raise ValueError("Need either a dataset name or a training folder.")
 
+    # validates checkpoints_total_limit before any work is done
+    checkpointer = AsyncCheckpointer(args.output_dir, args.checkpoints_total_limit)
+
     hub_token = flytekit.current_context().secrets.get(SECRET_GROUP, SECRET_KEY)
 
     logging_dir = Path(args.output_dir, args.logging_dir)
@@ -218,6 +266,7 @@ def stable_diffusion_finetuning(args: FineTuningArgs) -> str:
     accelerator = Accelerator(
         gradient_accumulation_steps=args.gradient_accumulation_steps,
         mixed_precision=args.mixed_precision,
+        log_with=args.report_to,
         project_config=accelerator_project_config,
     )
 
@@ -315,20 +364,16 @@ def stable_diffusion_finetuning(args: FineTuningArgs) -> str:
         # only upcast trainable parameters (LoRA) into fp32
         cast_training_params(unet, dtype=torch.float32)
 
-    if args.enable_xformers_memory_efficient_attention:
-        if is_xformers_available():
-            import xformers
-
-            xformers_version = version.parse(xformers.__version__)
-            if xformers_version == version.parse("0.0.16"):
-                logger.warning(
-                    "xFormers 0.0.16 cannot be used for training in some GPUs. If you observe problems during training, please update xFormers to at least 0.0.17. See https://huggingface.co/docs/diffusers/main/en/optimization/xformers for more details."
-                )
-            unet.enable_xformers_memory_efficient_attention()
-        else:
-            raise ValueError(
-                "xformers is not available. Make sure it is installed correctly"
-            )
+    attention_backend = resolve_attention_backend(
+        (
+            "xformers"
+            if args.enable_xformers_memory_efficient_attention
+            else args.attention_backend
+        ),
+        accelerator.device,
+    )
+    logger.info(f"Using {attention_backend} attention")
+    set_attention_backend(unet, attention_backend)
 
     lora_layers = filter(lambda p: p.requires_grad, unet.parameters())
 
@@ -444,35 +489,23 @@ def stable_diffusion_finetuning(args: FineTuningArgs) -> str:
         )
         return inputs.input_ids
 
-    # Preprocessing the datasets.
-    train_transforms = transforms.Compose(
-        [
-            transforms.Resize(
-                args.resolution, interpolation=transforms.InterpolationMode.BILINEAR
-            ),
-            (
-                transforms.CenterCrop(args.resolution)
-                if args.center_crop
-                else transforms.RandomCrop(args.resolution)
-            ),
-            (
-                transforms.RandomHorizontalFlip()
-                if args.random_flip
-                else transforms.Lambda(lambda x: x)
-            ),
-            transforms.ToTensor(),
-            transforms.Normalize([0.5], [0.5]),
-        ]
-    )
-
     def unwrap_model(model):
         model = accelerator.unwrap_model(model)
         model = model._orig_mod if is_compiled_module(model) else model
         return model
 
+    def unet_lora_state_dict():
+        return convert_state_dict_to_diffusers(
+            get_peft_model_state_dict(unwrap_model(unet))
+        )
+
+    # images are decoded into uint8 tensors and cropped in the dataloader workers,
+    # flips and normalization run batched on the device in the training loop
     def preprocess_train(examples):
-        images = [image.convert("RGB") for image in examples[image_column]]
-        examples["pixel_values"] = [train_transforms(image) for image in images]
+        examples["pixel_values"] = [
+            crops[tuple(bucket)](decode_image(image))
+            for image, bucket in zip(examples[image_column], examples["bucket"])
+        ]
         examples["input_ids"] = tokenize_captions(examples)
         return examples
 
@@ -483,22 +516,91 @@ def stable_diffusion_finetuning(args: FineTuningArgs) -> str:
                 .shuffle(seed=args.seed)
                 .select(range(args.max_train_samples))
             )
+        if args.resolution_buckets:
+            bucket_tiers = make_buckets(args.resolution, args.min_bucket_resolution)
+            buckets = [
+                assign_bucket(width, height, bucket_tiers)
+                for width, height in image_sizes(dataset["train"], image_column)
+            ]
+        else:
+            buckets = [(args.resolution, args.resolution)] * len(dataset["train"])
+        dataset["train"] = (
+            dataset["train"]
+            .add_column("bucket", buckets)
+            .cast_column(image_column, datasets.Image(decode=False))
+        )
         # Set the training transforms
         train_dataset = dataset["train"].with_transform(preprocess_train)
+    crops = {bucket: CropToSize(bucket, args.center_crop) for bucket in set(buckets)}
+
+    vae_scaling_factor = vae.config.scaling_factor
+    vae_scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+    if args.cache_latents:
+        # a center crop is the same every time, random crops need variants to pick from
+        num_crops = 1 if args.center_crop else args.latent_cache_crops
+        if num_crops < 1:
+            raise ValueError("latent_cache_crops must be at least 1")
+        build_latent_cache(
+            accelerator,
+            vae,
+            tokenizer,
+            dataset["train"],
+            image_column,
+            caption_column,
+            buckets,
+            crops,
+            args.random_flip,
+            args.latent_cache_dir,
+            meta={
+                "pretrained_model_name_or_path": args.pretrained_model_name_or_path,
+                "revision": args.revision,
+                "variant": args.variant,
+                "dataset": dataset["train"]._fingerprint,
+                "seed": args.seed,
+                "resolution": args.resolution,
+                "center_crop": args.center_crop,
+                "random_flip": args.random_flip,
+                "resolution_buckets": args.resolution_buckets,
+                "min_bucket_resolution": args.min_bucket_resolution,
+                "num_crops": num_crops,
+            },
+            batch_size=args.latent_cache_batch_size,
+            num_crops=num_crops,
+        )
+        train_dataset = LatentCacheDataset(args.latent_cache_dir)
+
+        # the vae isn't needed anymore once the latents are cached
+        del vae
+        torch.cuda.empty_cache()
 
     def collate_fn(examples):
         pixel_values = torch.stack([example["pixel_values"] for example in examples])
-        pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
         input_ids = torch.stack([example["input_ids"] for example in examples])
         return {"pixel_values": pixel_values, "input_ids": input_ids}
 
     # DataLoaders creation:
+    if args.resolution_buckets:
+        # every batch holds images of a single bucket. Partial batches are
+        # dropped, since accelerate shards whole batches across processes and
+        # uneven ones would leave processes with different numbers of steps
+        batching = {
+            "batch_sampler": BucketBatchSampler(
+                buckets, args.train_batch_size, seed=args.seed, drop_last=True
+            )
+        }
+    else:
+        batching = {"shuffle": True, "batch_size": args.train_batch_size}
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
-        shuffle=True,
-        collate_fn=collate_fn,
-        batch_size=args.train_batch_size,
+        collate_fn=None if args.cache_latents else collate_fn,
         num_workers=args.dataloader_num_workers,
+        # keep the workers and their prefetched batches alive across epochs
+        persistent_workers=args.dataloader_num_workers > 0,
+        prefetch_factor=(
+            args.dataloader_prefetch_factor if args.dataloader_num_workers > 0 else None
+        ),
+        pin_memory=True,
+        **batching,
     )
 
     # Scheduler and math around the number of training steps.
@@ -522,6 +624,15 @@ def stable_diffusion_finetuning(args: FineTuningArgs) -> str:
         unet, optimizer, train_dataloader, lr_scheduler
     )
 
+    # a process with more batches than the others would wait forever in all-reduce
+    num_batches = accelerator.gather(
+        torch.tensor([len(train_dataloader)], device=accelerator.device)
+    )
+    if len(set(num_batches.tolist())) > 1:
+        raise ValueError(
+            f"Processes got different numbers of batches: {num_batches.tolist()}"
+        )
+
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(
         len(train_dataloader) / args.gradient_accumulation_steps
@@ -574,7 +685,8 @@ def stable_diffusion_finetuning(args: FineTuningArgs) -> str:
             initial_global_step = 0
         else:
             accelerator.print(f"Resuming from checkpoint {path}")
-            accelerator.load_state(os.path.join(args.output_dir, path))
+            # checkpoints hold only the trainable weights of the unet
+            accelerator.load_state(os.path.join(args.output_dir, path), strict=False)
             global_step = int(path.split("-")[1])
 
             initial_global_step = global_step
@@ -590,16 +702,30 @@ def stable_diffusion_finetuning(args: FineTuningArgs) -> str:
         disable=not accelerator.is_local_main_process,
     )
 
+    bucket_throughput = BucketThroughput()
+    telemetry = StepTelemetry(
+        accelerator.device,
+        accelerator.num_processes,
+        enabled=args.telemetry_steps > 0,
+    )
     for epoch in range(first_epoch, args.num_train_epochs):
         unet.train()
         train_loss = 0.0
+        bucket_throughput.reset()
         for step, batch in enumerate(train_dataloader):
+            telemetry.start_step()
             with accelerator.accumulate(unet):
                 # Convert images to latent space
-                latents = vae.encode(
-                    batch["pixel_values"].to(dtype=weight_dtype)
-                ).latent_dist.sample()
-                latents = latents * vae.config.scaling_factor
+                if args.cache_latents:
+                    latents = sample_latents(
+                        batch["latent_params"].to(dtype=weight_dtype)
+                    )
+                else:
+                    pixel_values = normalize_batch(
+                        batch["pixel_values"], args.random_flip, weight_dtype
+                    )
+                    latents = vae.encode(pixel_values).latent_dist.sample()
+                latents = latents * vae_scaling_factor
 
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(latents)
@@ -679,97 +805,100 @@ def stable_diffusion_finetuning(args: FineTuningArgs) -> str:
                     )
                     loss = loss.mean()
 
+                telemetry.mark("forward")
+
                 # Gather the losses across all processes for logging (if we use distributed training).
-                avg_loss = accelerator.gather(loss.repeat(args.train_batch_size)).mean()
-                train_loss += avg_loss.item() / args.gradient_accumulation_steps
+                if args.gather_loss:
+                    avg_loss = accelerator.gather(
+                        loss.repeat(args.train_batch_size)
+                    ).mean()
+                    train_loss += avg_loss.item() / args.gradient_accumulation_steps
+                    telemetry.mark("gather")
 
                 # Backpropagate
                 accelerator.backward(loss)
+                telemetry.mark("backward")
                 if accelerator.sync_gradients:
                     params_to_clip = lora_layers
                     accelerator.clip_grad_norm_(params_to_clip, args.max_grad_norm)
                 optimizer.step()
                 lr_scheduler.step()
                 optimizer.zero_grad()
+                telemetry.mark("optimizer")
+
+            bucket_throughput.step(
+                (
+                    latents.shape[-1] * vae_scale_factor,
+                    latents.shape[-2] * vae_scale_factor,
+                ),
+                bsz,
+            )
+            telemetry.end_step(
+                bsz,
+                count_tokens(batch["input_ids"], tokenizer.pad_token_id),
+                None if args.gather_loss else loss,
+            )
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
                 progress_bar.update(1)
                 global_step += 1
-                accelerator.log({"train_loss": train_loss}, step=global_step)
+                if args.gather_loss:
+                    accelerator.log({"train_loss": train_loss}, step=global_step)
                 train_loss = 0.0
 
-                if global_step % args.checkpointing_steps == 0:
-                    if accelerator.is_main_process:
-                        # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
-                        if args.checkpoints_total_limit is not None:
-                            checkpoints = os.listdir(args.output_dir)
-                            checkpoints = [
-                                d for d in checkpoints if d.startswith("checkpoint")
-                            ]
-                            checkpoints = sorted(
-                                checkpoints, key=lambda x: int(x.split("-")[1])
-                            )
-
-                            # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
-                            if len(checkpoints) >= args.checkpoints_total_limit:
-                                num_to_remove = (
-                                    len(checkpoints) - args.checkpoints_total_limit + 1
-                                )
-                                removing_checkpoints = checkpoints[0:num_to_remove]
-
-                                logger.info(
-                                    f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
-                                )
-                                logger.info(
-                                    f"removing checkpoints: {', '.join(removing_checkpoints)}"
-                                )
-
-                                for removing_checkpoint in removing_checkpoints:
-                                    removing_checkpoint = os.path.join(
-                                        args.output_dir, removing_checkpoint
-                                    )
-                                    shutil.rmtree(removing_checkpoint)
-
-                        save_path = os.path.join(
-                            args.output_dir, f"checkpoint-{global_step}"
+                if telemetry.enabled and global_step % args.telemetry_steps == 0:
+                    accelerator.log(telemetry.report(), step=global_step)
+                    telemetry.reset()
+
+                if accelerator.is_main_process:
+                    stalled = None
+                    if global_step % args.checkpointing_steps == 0:
+                        stalled = checkpointer.save_state(
+                            global_step,
+                            accelerator,
+                            unet,
+                            optimizer,
+                            lr_scheduler,
+                            unet_lora_state_dict(),
                         )
-                        accelerator.save_state(save_path)
-
-                        unwrapped_unet = unwrap_model(unet)
-                        unet_lora_state_dict = convert_state_dict_to_diffusers(
-                            get_peft_model_state_dict(unwrapped_unet)
+                    elif (
+                        args.lora_checkpointing_steps
+                        and global_step % args.lora_checkpointing_steps == 0
+                    ):
+                        stalled = checkpointer.save_lora(
+                            global_step, unet_lora_state_dict()
                         )
-
-                        StableDiffusionPipeline.save_lora_weights(
-                            save_directory=save_path,
-                            unet_lora_layers=unet_lora_state_dict,
-                            safe_serialization=True,
+                    if stalled is not None:
+                        accelerator.log(
+                            {"checkpoint_stall_seconds": stalled}, step=global_step
                         )
 
-                        logger.info(f"Saved state to {save_path}")
-
-            logs = {
-                "step_loss": loss.detach().item(),
-                "lr": lr_scheduler.get_last_lr()[0],
-            }
+            logs = {"lr": lr_scheduler.get_last_lr()[0]}
+            if args.gather_loss:
+                logs["step_loss"] = loss.detach().item()
             progress_bar.set_postfix(**logs)
 
             if global_step >= args.max_train_steps:
                 break
 
+        bucket_report = bucket_throughput.report()
+        logger.info(f"Samples per second by bucket: {bucket_report}")
+        accelerator.log(bucket_report, step=global_step)
+
     # Save the lora layers
+    if accelerator.is_main_process:
+        checkpointer.wait()
+        logger.info(
+            f"Training stalled for {checkpointer.stalled_seconds:.1f}s at checkpoints"
+        )
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
         unet = unet.to(torch.float32)
 
-        unwrapped_unet = unwrap_model(unet)
-        unet_lora_state_dict = convert_state_dict_to_diffusers(
-            get_peft_model_state_dict(unwrapped_unet)
-        )
         StableDiffusionPipeline.save_lora_weights(
             save_directory=args.output_dir,
-            unet_lora_layers=unet_lora_state_dict,
+            unet_lora_layers=unet_lora_state_dict(),
             safe_serialization=True,
         )
 
@@ -0,0 +1,73 @@
+import io
+import math
+import random
+from typing import Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.io import ImageReadMode, decode_image as decode_image_data
+from torchvision.transforms.v2 import functional as TF
+
+
+def decode_image(image: dict) -> torch.Tensor:
+    """Decodes an undecoded `datasets.Image` entry into a uint8 CHW RGB tensor."""
+    if image["bytes"] is None:
+        with open(image["path"], "rb") as f:
+            data = f.read()
+    else:
+        data = image["bytes"]
+    try:
+        return decode_image_data(
+            torch.frombuffer(bytearray(data), dtype=torch.uint8),
+            mode=ImageReadMode.RGB,
+        )
+    except RuntimeError:
+        # torchvision only decodes jpeg and png, everything else goes through PIL
+        with Image.open(io.BytesIO(data)) as f:
+            array = np.asarray(f.convert("RGB"))
+        return torch.from_numpy(array.copy()).permute(2, 0, 1)
+
+
+class CropToSize:
+    """Resizes a uint8 image to the smallest size that covers (width, height)
+    and crops it to that size, in the center or at a random offset."""
+
+    def __init__(self, size: Tuple[int, int], center_crop: bool):
+        self.width, self.height = size
+        self.center_crop = center_crop
+
+    def __call__(self, image: torch.Tensor) -> torch.Tensor:
+        image_height, image_width = image.shape[-2:]
+        scale = max(self.width / image_width, self.height / image_height)
+        image = TF.resize(
+            image,
+            [
+                max(self.height, math.ceil(image_height * scale)),
+                max(self.width, math.ceil(image_width * scale)),
+            ],
+            antialias=True,
+        )
+
+        if self.center_crop:
+            return TF.center_crop(image, [self.height, self.width])
+        top = random.randint(0, image.shape[-2] - self.height)
+        left = random.randint(0, image.shape[-1] - self.width)
+        return image[..., top : top + self.height, left : left + self.width]
+
+
+def normalize_batch(
+    pixel_values: torch.Tensor, random_flip: bool, dtype: torch.dtype
+) -> torch.Tensor:
+    """Scales a uint8 image batch to [-1, 1] and mirrors a random half of it.
+
+    Runs on whichever device the batch is on, so call it after the batch has
+    been moved to the GPU.
+    """
+    pixel_values = (pixel_values.float() / 127.5 - 1).to(dtype)
+    if random_flip:
+        flip = torch.rand(len(pixel_values), device=pixel_values.device) < 0.5
+        pixel_values = torch.where(
+            flip[:, None, None, None], pixel_values.flip(-1), pixel_values
+        )
+    return pixel_values
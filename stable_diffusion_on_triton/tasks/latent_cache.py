@@ -0,0 +1,193 @@
+import json
+import os
+import random
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
+
+from stable_diffusion_on_triton.tasks.buckets import Bucket
+from stable_diffusion_on_triton.tasks.input_pipeline import (
+    decode_image,
+    normalize_batch,
+)
+
+INPUT_IDS_FILE = "input_ids.npy"
+NUM_CAPTIONS_FILE = "num_captions.npy"
+ROWS_FILE = "rows.npy"
+# written last, so that an interrupted precompute is never read back
+META_FILE = "meta.json"
+
+
+def _latents_file(bucket: Bucket) -> str:
+    return f"latents_{bucket[0]}x{bucket[1]}.npy"
+
+
+def _captions(caption) -> List[str]:
+    if isinstance(caption, str):
+        return [caption]
+    if isinstance(caption, (list, np.ndarray)):
+        return list(caption)
+    raise ValueError(
+        "Caption column should contain either strings or lists of strings."
+    )
+
+
+def load_meta(cache_dir: str) -> Optional[dict]:
+    path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+@torch.no_grad()
+def build_latent_cache(
+    accelerator,
+    vae,
+    tokenizer,
+    dataset,
+    image_column: str,
+    caption_column: str,
+    buckets: Sequence[Bucket],
+    crops: Dict[Bucket, Callable],
+    random_flip: bool,
+    cache_dir: str,
+    meta: dict,
+    batch_size: int = 8,
+    num_crops: int = 1,
+):
+    """Encodes every image of `dataset` once into memory-mapped arrays in `cache_dir`.
+
+    The parameters of the vae's latent distribution are stored rather than a
+    sample of it, so training still samples fresh latents every epoch. They are
+    stored for `num_crops` crops of the image to its bucket, each of them also
+    mirrored with `random_flip`, next to the token ids of all its captions. `dataset` holds
+    undecoded images and every bucket gets its own array. The batches are split
+    across processes, and a cache built with the same `meta` is reused.
+    """
+    if load_meta(cache_dir) == meta:
+        return
+
+    # the row of every image in the array of its bucket
+    groups = defaultdict(list)
+    for index, bucket in enumerate(buckets):
+        groups[tuple(bucket)].append(index)
+    rows = np.zeros((len(dataset), 3), dtype=np.int32)
+    for (width, height), indices in groups.items():
+        rows[indices, 0], rows[indices, 1] = width, height
+        rows[indices, 2] = np.arange(len(indices))
+
+    num_flips = 2 if random_flip else 1
+    num_variants = num_crops * num_flips
+    scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+    if accelerator.is_main_process:
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(os.path.join(cache_dir, META_FILE)):
+            os.remove(os.path.join(cache_dir, META_FILE))
+
+        captions = [_captions(caption) for caption in dataset[caption_column]]
+        num_captions = np.array([len(c) for c in captions], dtype=np.int32)
+        input_ids = np.lib.format.open_memmap(
+            os.path.join(cache_dir, INPUT_IDS_FILE),
+            mode="w+",
+            dtype=np.int32,
+            shape=(len(dataset), int(num_captions.max()), tokenizer.model_max_length),
+        )
+        for index, image_captions in enumerate(captions):
+            input_ids[index, : len(image_captions)] = tokenizer(
+                image_captions,
+                max_length=tokenizer.model_max_length,
+                padding="max_length",
+                truncation=True,
+                return_tensors="np",
+            ).input_ids
+        input_ids.flush()
+        np.save(os.path.join(cache_dir, NUM_CAPTIONS_FILE), num_captions)
+        np.save(os.path.join(cache_dir, ROWS_FILE), rows)
+
+        for (width, height), indices in groups.items():
+            np.lib.format.open_memmap(
+                os.path.join(cache_dir, _latents_file((width, height))),
+                mode="w+",
+                dtype=np.float16,
+                shape=(
+                    len(indices),
+                    num_variants,
+                    2 * vae.config.latent_channels,
+                    height // scale_factor,
+                    width // scale_factor,
+                ),
+            ).flush()
+    accelerator.wait_for_everyone()
+
+    batches = [
+        (bucket, indices[start : start + batch_size])
+        for bucket, indices in groups.items()
+        for start in range(0, len(indices), batch_size)
+    ]
+    for bucket, indices in batches[
+        accelerator.process_index :: accelerator.num_processes
+    ]:
+        latents = np.load(
+            os.path.join(cache_dir, _latents_file(bucket)), mmap_mode="r+"
+        )
+        images = [decode_image(image) for image in dataset[indices][image_column]]
+        for crop in range(num_crops):
+            pixel_values = torch.stack([crops[bucket](image) for image in images])
+            pixel_values = normalize_batch(
+                pixel_values.to(vae.device), random_flip=False, dtype=vae.dtype
+            )
+            flips = [pixel_values, pixel_values.flip(-1)][:num_flips]
+            for flip, pixels in enumerate(flips):
+                parameters = vae.encode(pixels).latent_dist.parameters
+                latents[rows[indices, 2], crop * num_flips + flip] = (
+                    parameters.cpu().numpy().astype(np.float16)
+                )
+        latents.flush()
+        del latents
+    accelerator.wait_for_everyone()
+
+    if accelerator.is_main_process:
+        with open(os.path.join(cache_dir, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+    accelerator.wait_for_everyone()
+
+
+class LatentCacheDataset(torch.utils.data.Dataset):
+    """Reads the cached latent distributions and token ids of each image,
+    picking one of its crops, flips and captions at random."""
+
+    def __init__(self, cache_dir: str):
+        self.rows = np.load(os.path.join(cache_dir, ROWS_FILE))
+        self.buckets = [(int(width), int(height)) for width, height, _ in self.rows]
+        self.latents = {
+            bucket: np.load(
+                os.path.join(cache_dir, _latents_file(bucket)), mmap_mode="r"
+            )
+            for bucket in set(self.buckets)
+        }
+        self.input_ids = np.load(os.path.join(cache_dir, INPUT_IDS_FILE), mmap_mode="r")
+        self.num_captions = np.load(os.path.join(cache_dir, NUM_CAPTIONS_FILE))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        latents = self.latents[self.buckets[index]]
+        variant = random.randrange(latents.shape[1])
+        caption = random.randrange(self.num_captions[index])
+        return {
+            "latent_params": torch.from_numpy(
+                np.array(latents[self.rows[index, 2], variant])
+            ),
+            "input_ids": torch.from_numpy(
+                self.input_ids[index, caption].astype(np.int64)
+            ),
+        }
+
+
+def sample_latents(latent_params: torch.Tensor) -> torch.Tensor:
+    return DiagonalGaussianDistribution(latent_params).sample()
@@ -1,7 +1,9 @@
+import json
+import logging
 import os
 import shutil
-import subprocess
 import tarfile
+import tempfile
 
 import flytekit
 from flytekit import ImageSpec, Resources, task
@@ -9,6 +11,9 @@ from flytekit.extras.accelerators import T4
 from flytekit.types.directory import FlyteDirectory
 from flytekit.types.file import FlyteFile
 
+from stable_diffusion_on_triton.tasks.build_cache import BuildCache, component_keys
+from stable_diffusion_on_triton.tasks.tuning import TuningProfile, write_model_configs
+
 sd_compilation_image = ImageSpec(
     name="sd_optimization",
     registry=os.getenv("REGISTRY"),
@@ -29,58 +34,96 @@ sd_compilation_image = ImageSpec(
 ).with_commands(
     [
         "/usr/src/tensorrt/bin/trtexec --help",  # check if trtexec is available
-        "chmod +x /root/export.sh",
     ]
 )
 
+if sd_compilation_image.is_container():
+    from export import MANIFEST_FILE, Exporter, engine_target
+    from quantize import QUANTIZATION_MODES
+
+logger = logging.getLogger(__name__)
+
 
 @task(
     cache=True,
-    cache_version="2",
+    cache_version="8",
     container_image=sd_compilation_image,
     requests=Resources(gpu="1", mem="20Gi"),
     accelerator=T4,
 )
-def optimize_model(model_name: str, repo_id: str) -> FlyteDirectory:
+def optimize_model(
+    model_name: str,
+    repo_id: str,
+    tuning_profile: TuningProfile = TuningProfile(),
+    build_cache: str = "",
+    quantization: str = "none",
+) -> FlyteDirectory:
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(
+            f"Unknown quantization mode '{quantization}', "
+            f"expected one of {', '.join(QUANTIZATION_MODES)}"
+        )
     model_repository = flytekit.current_context().working_directory
-    vae_dir = os.path.join(model_repository, "vae")
-    encoder_dir = os.path.join(model_repository, "text_encoder")
-    pipeline_dir = os.path.join(model_repository, "pipeline")
-
-    os.makedirs(vae_dir, exist_ok=True)
-    os.makedirs(encoder_dir, exist_ok=True)
-    os.makedirs(pipeline_dir, exist_ok=True)
-
-    vae_1_dir = os.path.join(vae_dir, "1")
-    encoder_1_dir = os.path.join(encoder_dir, "1")
-
-    os.makedirs(vae_1_dir, exist_ok=True)
-    os.makedirs(encoder_1_dir, exist_ok=True)
 
-    vae_plan = os.path.join(vae_1_dir, "model.plan")
-    encoder_onnx = os.path.join(encoder_1_dir, "model.onnx")
-
-    result = subprocess.run(
-        f"/root/export.sh {vae_plan} {encoder_onnx} {repo_id} {model_name}",
-        capture_output=True,
-        text=True,
-        shell=True,
+    # reuse the artifacts of every component whose inputs haven't changed,
+    # so that a LoRA-only update rebuilds just the unet
+    keys = component_keys(
+        model_name,
+        repo_id,
+        ["/root/export.py", "/root/quantize.py"],
+        quantization,
+        engine_target(),
     )
-
-    # Check the return code
-    if result.returncode == 0:
-        print("Script execution succeeded")
-        print(f"stdout: {result.stdout}")
-    else:
-        print("Script execution failed")
-        print(f"stderr: {result.stderr}")
-
-    shutil.copy("/root/vae_config.pbtxt", os.path.join(vae_dir, "config.pbtxt"))
+    cache = BuildCache(build_cache) if build_cache else None
+    components = [
+        component
+        for component, key in keys.items()
+        if cache is None or not cache.fetch(component, key, model_repository)
+    ]
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    logger.info(f"Components to export: {components}")
+
+    # fetched components are recorded with the key they were cached under
+    manifest = {
+        component: {"cached": key}
+        for component, key in keys.items()
+        if component not in components
+    }
+    if components:
+        exporter = Exporter(
+            model_name,
+            repo_id,
+            model_repository,
+            work_dir=tempfile.mkdtemp(),
+            quantization=quantization,
+        )
+        manifest.update(exporter.run(components))
+
+        if cache is not None:
+            for component in components:
+                cache.store(component, keys[component], model_repository)
+
+    with open(os.path.join(model_repository, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    for component in keys:
+        shutil.copy(
+            f"/root/{component}_config.pbtxt",
+            os.path.join(model_repository, component, "config.pbtxt"),
+        )
+    shutil.copytree(
+        "/root/pipeline",
+        os.path.join(model_repository, "pipeline"),
+        dirs_exist_ok=True,
+    )
+    # shared with fine-tuning, which imports it from the backend package
     shutil.copy(
-        "/root/text_encoder_config.pbtxt",
-        os.path.join(encoder_dir, "config.pbtxt"),
+        "/root/attention_backends.py",
+        os.path.join(model_repository, "pipeline", "1"),
     )
-    shutil.copytree("/root/pipeline", pipeline_dir, dirs_exist_ok=True)
+
+    # instance counts, batching and caching of every model come from the profile
+    write_model_configs(model_repository, tuning_profile)
 
     return FlyteDirectory(model_repository)
 
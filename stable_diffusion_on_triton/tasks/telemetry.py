@@ -0,0 +1,128 @@
+import resource
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Union
+
+import torch
+
+PHASES = ("data_wait", "forward", "backward", "optimizer", "gather")
+
+
+def count_tokens(input_ids: torch.Tensor, pad_token_id: int) -> torch.Tensor:
+    """Counts the caption tokens that aren't padding, on the device of
+    `input_ids` so the step isn't waited for. CLIP pads with its end of text
+    token, so that one isn't counted either."""
+    return (input_ids != pad_token_id).sum()
+
+
+class StepTelemetry:
+    """Times the phases of training steps and aggregates throughput and peak memory.
+
+    A step runs from `start_step` through its phases, each ended by `mark`, to
+    `end_step`. On CUDA the phases are timed with events recorded on the current
+    stream, so nothing synchronizes the device until `report`. The data wait is
+    the host time between the end of a step and the start of the next one.
+    A disabled instance records nothing.
+    """
+
+    def __init__(
+        self, device: torch.device, num_processes: int = 1, enabled: bool = True
+    ):
+        self.enabled = enabled
+        self.device = device
+        self.cuda = device.type == "cuda"
+        self.num_processes = num_processes
+        self.reset()
+
+    def reset(self):
+        if not self.enabled:
+            return
+        self.pending = []
+        self.seconds = defaultdict(float)
+        self.steps = 0
+        self.samples = 0
+        self.tokens = 0
+        self.loss = None
+        self.losses = 0
+        self.started = self.step_ended = time.perf_counter()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _mark(self):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start_step(self):
+        if not self.enabled:
+            return
+        self.seconds["data_wait"] += time.perf_counter() - self.step_ended
+        self.last = self._mark()
+
+    def mark(self, name: str):
+        """Ends the phase `name`, which started at the previous mark."""
+        if not self.enabled:
+            return
+        mark = self._mark()
+        self.pending.append((name, self.last, mark))
+        self.last = mark
+
+    def end_step(
+        self,
+        samples: int,
+        tokens: Union[int, torch.Tensor],
+        loss: Optional[torch.Tensor] = None,
+    ):
+        """Counts a step of `samples` images and `tokens` caption tokens on this
+        process, and accumulates its tokens and loss without reading them back."""
+        if not self.enabled:
+            return
+        self.steps += 1
+        self.samples += samples
+        self.tokens += tokens
+        if loss is not None:
+            loss = loss.detach().float()
+            self.loss = loss if self.loss is None else self.loss + loss
+            self.losses += 1
+        self.step_ended = time.perf_counter()
+
+    def report(self) -> Dict[str, float]:
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        for name, start, end in self.pending:
+            if self.cuda:
+                self.seconds[name] += start.elapsed_time(end) / 1000
+            else:
+                self.seconds[name] += end - start
+        self.pending = []
+
+        elapsed = time.perf_counter() - self.started
+        steps = max(self.steps, 1)
+        report = {
+            f"time/{name}_ms": self.seconds[name] * 1000 / steps
+            for name in PHASES
+            if name in self.seconds
+        }
+        # every process takes steps of the same size
+        report["throughput/samples_per_second"] = (
+            self.samples * self.num_processes / elapsed
+        )
+        report["throughput/tokens_per_second"] = (
+            float(self.tokens) * self.num_processes / elapsed
+        )
+        if self.cuda:
+            report["memory/peak_allocated_gb"] = (
+                torch.cuda.max_memory_allocated(self.device) / 2**30
+            )
+            report["memory/peak_reserved_gb"] = (
+                torch.cuda.max_memory_reserved(self.device) / 2**30
+            )
+        # ru_maxrss is in kilobytes on linux
+        report["memory/peak_host_rss_gb"] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+        )
+        if self.loss is not None:
+            report["train_loss_local"] = self.loss.item() / self.losses
+        return report
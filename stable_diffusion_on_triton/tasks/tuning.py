@@ -0,0 +1,105 @@
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from mashumaro.mixins.json import DataClassJSONMixin
+
+# config blocks that are generated from the tuning profile
+TUNED_BLOCKS = ("instance_group", "dynamic_batching", "response_cache")
+
+TUNING_PROFILE_FILE = "tuning_profile.json"
+
+
+@dataclass
+class ModelTuning(DataClassJSONMixin):
+    instance_count: int = 1
+    dynamic_batching: bool = True
+    preferred_batch_sizes: List[int] = field(default_factory=list)
+    max_queue_delay_microseconds: int = 0
+    # needs the server to run with --cache-config
+    response_cache: bool = False
+
+
+def default_models() -> Dict[str, ModelTuning]:
+    return {
+        "pipeline": ModelTuning(
+            preferred_batch_sizes=[4, 8], max_queue_delay_microseconds=100000
+        ),
+        # the embedding of a prompt never changes, so repeated prompts are served
+        # from the cache across pipeline instances
+        "text_encoder": ModelTuning(response_cache=True),
+        "vae": ModelTuning(),
+        "unet": ModelTuning(),
+    }
+
+
+@dataclass
+class TuningProfile(DataClassJSONMixin):
+    models: Dict[str, ModelTuning] = field(default_factory=default_models)
+
+
+def _strip_block(config: str, name: str) -> str:
+    # removes a top-level block along with the comment lines right above it
+    match = re.search(rf"^((?:#.*\n)*){name}\s*[\[{{]", config, re.MULTILINE)
+    if match is None:
+        return config
+
+    depth = 0
+    for end in range(match.end() - 1, len(config)):
+        if config[end] in "[{":
+            depth += 1
+        elif config[end] in "]}":
+            depth -= 1
+            if depth == 0:
+                break
+    return config[: match.start()] + config[end + 1 :].lstrip("\n")
+
+
+def render_config(config: str, tuning: ModelTuning) -> str:
+    for name in TUNED_BLOCKS:
+        config = _strip_block(config, name)
+
+    blocks = [
+        "instance_group [\n"
+        "  {\n"
+        f"    count: {tuning.instance_count}\n"
+        "    kind: KIND_GPU\n"
+        "  }\n"
+        "]"
+    ]
+    if tuning.dynamic_batching:
+        lines = []
+        if tuning.preferred_batch_sizes:
+            sizes = ", ".join(str(size) for size in tuning.preferred_batch_sizes)
+            lines.append(f"  preferred_batch_size: [ {sizes} ]")
+        lines.append(
+            f"  max_queue_delay_microseconds: {tuning.max_queue_delay_microseconds}"
+        )
+        blocks.append("dynamic_batching {\n" + "\n".join(lines) + "\n}")
+    if tuning.response_cache:
+        blocks.append("response_cache {\n  enable: true\n}")
+
+    return (
+        config.rstrip()
+        + "\n\n# generated from the tuning profile\n"
+        + "\n\n".join(blocks)
+        + "\n"
+    )
+
+
+def write_model_configs(model_repository: str, profile: TuningProfile):
+    """Renders the profile into the config.pbtxt of every model in the repository
+    and records it next to them in tuning_profile.json."""
+    for model_name, tuning in profile.models.items():
+        config_path = os.path.join(model_repository, model_name, "config.pbtxt")
+        if not os.path.exists(config_path):
+            continue
+        with open(config_path) as f:
+            config = f.read()
+        with open(config_path, "w") as f:
+            f.write(render_config(config, tuning))
+
+    with open(os.path.join(model_repository, TUNING_PROFILE_FILE), "w") as f:
+        json.dump(profile.to_dict(), f, indent=2)
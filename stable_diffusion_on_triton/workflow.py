@@ -6,12 +6,16 @@ from stable_diffusion_on_triton.tasks.fine_tune import (
     stable_diffusion_finetuning,
 )
 from stable_diffusion_on_triton.tasks.optimize import compress_model, optimize_model
+from stable_diffusion_on_triton.tasks.tuning import TuningProfile
 
 
 @workflow
 def stable_diffusion_on_triton_wf(
     execution_role_arn: str,
     finetuning_args: FineTuningArgs = FineTuningArgs(),
+    tuning_profile: TuningProfile = TuningProfile(),
+    build_cache: str = "",
+    quantization: str = "none",  # "dynamic" or "static" adds int8 cpu models
     model_name: str = "stable-diffusion-model",
     endpoint_config_name: str = "stable-diffusion-endpoint-config",
     endpoint_name: str = "stable-diffusion-endpoint",
@@ -23,6 +27,9 @@ def stable_diffusion_on_triton_wf(
     model_repo = optimize_model(
         model_name=finetuning_args.pretrained_model_name_or_path,
         repo_id=repo_id,
+        tuning_profile=tuning_profile,
+        build_cache=build_cache,
+        quantization=quantization,
     )
     compressed_model = compress_model(model_repo=model_repo)
     deployment = sd_deployment(